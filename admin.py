@@ -1,9 +1,15 @@
 import re
+from functools import lru_cache
+
 from config import ADMIN_WHATSAPP
 
+_NON_DIGIT_RE = re.compile(r"[^\d+]")
+
+
+@lru_cache(maxsize=1024)
 def normalize_admin_number(s: str) -> str:
     raw = (s or "").strip().replace("whatsapp:", "").strip()
-    digits = re.sub(r"[^\d+]", "", raw)
+    digits = _NON_DIGIT_RE.sub("", raw)
 
     if digits.startswith("0") and len(digits) == 10:
         return "+254" + digits[1:]
@@ -13,15 +19,14 @@ def normalize_admin_number(s: str) -> str:
 
     return digits
 
-def is_admin(user_number: str, clinic_settings: dict) -> bool:
-    admins = clinic_settings.get("admins", [])
-    user_norm = normalize_admin_number(user_number)
-
-    for a in admins:
-        if user_norm == normalize_admin_number(str(a)):
-            return True
-
+@lru_cache(maxsize=256)
+def _normalized_admin_set(admins: tuple) -> frozenset:
+    out = {normalize_admin_number(str(a)) for a in admins}
     if ADMIN_WHATSAPP:
-        return user_norm == normalize_admin_number(ADMIN_WHATSAPP)
+        out.add(normalize_admin_number(ADMIN_WHATSAPP))
+    return frozenset(out)
 
-    return False
+def is_admin(user_number: str, clinic_settings: dict) -> bool:
+    admins = clinic_settings.get("admins", []) or []
+    user_norm = normalize_admin_number(user_number)
+    return user_norm in _normalized_admin_set(tuple(admins))
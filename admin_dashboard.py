@@ -1,5 +1,4 @@
 import json
-import os
 from functools import wraps
 
 from flask import (
@@ -7,7 +6,8 @@ from flask import (
     session, render_template_string
 )
 
-from db import db_conn
+from config import DASHBOARD_PASSWORD
+from db import get_conn
 from clinic import validate_clinic_settings
 from clinic_twilio import mask_twilio_profile
 
@@ -129,7 +129,7 @@ BASE_HTML = """
 
 
 def _dashboard_password():
-    return os.getenv("DASHBOARD_PASSWORD", "").strip()
+    return DASHBOARD_PASSWORD
 
 
 def dashboard_login_required(fn):
@@ -151,21 +151,15 @@ def _render_page(title, content):
 
 
 def _fetchall(query, params=None):
-    conn = db_conn()
-    c = conn.cursor()
-    c.execute(query, params or ())
-    rows = c.fetchall()
-    conn.close()
-    return rows
+    with get_conn() as conn, conn.cursor() as c:
+        c.execute(query, params or ())
+        return c.fetchall()
 
 
 def _fetchone(query, params=None):
-    conn = db_conn()
-    c = conn.cursor()
-    c.execute(query, params or ())
-    row = c.fetchone()
-    conn.close()
-    return row
+    with get_conn() as conn, conn.cursor() as c:
+        c.execute(query, params or ())
+        return c.fetchone()
 
 
 @admin_dashboard_bp.route("/admin/login", methods=["GET", "POST"])
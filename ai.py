@@ -1,6 +1,19 @@
+import hashlib
+import logging
+import threading
+import time
+
+import httpx
 from openai import OpenAI
-from config import OPENAI_API_KEY, CLINIC_NAME
-from db import load_recent_messages
+from config import (
+    OPENAI_API_KEY, CLINIC_NAME, OPENAI_TIMEOUT_SECONDS, OPENAI_MAX_RETRIES,
+    OPENAI_MAX_CONNECTIONS, OPENAI_KEEPALIVE_EXPIRY_SECONDS,
+)
+from db import (
+    load_recent_messages, load_messages_after,
+    load_conversation_summary, save_conversation_summary,
+)
+from jobs import enqueue_job, has_pending_job_for_user
 import json
 
 # ✅ Marker that routes.py can use if AI explicitly offers booking in normal chat replies
@@ -8,12 +21,53 @@ OFFER_BOOKING_MARKER = "<<OFFER_BOOKING>>"
 
 openai_client = None
 
+logger = logging.getLogger("ai")
+
+# Raw turns sent per reply; older turns are folded into a stored summary
+HISTORY_LIMIT = 12
+SUMMARY_KEEP_RECENT = 4
+# After a summarize_history job fails for good, wait this long before queueing another
+SUMMARY_RETRY_AFTER_MINUTES = 30
+
+# Rough input budget for raw history (~4 chars per token -> ~1500 tokens)
+HISTORY_CHAR_BUDGET = 6000
+
+# Exact-match reply cache for repeated FAQ turns ("what are your hours?").
+# Keyed on clinic id + name, summary, the previous assistant turn and the normalized
+# question, so the same words in a different conversation context miss.
+REPLY_CACHE_TTL_SECONDS = 24 * 3600
+REPLY_CACHE_MAX = 512
+_reply_cache = {}
+_reply_cache_lock = threading.Lock()
+
+SUMMARY_PROMPT = """
+You maintain a short running summary of a WhatsApp chat between a dental clinic receptionist and a patient.
+Merge the existing summary with the new messages.
+Keep names, requested dates/times, booking or cancellation outcomes and open questions.
+Write at most 6 short lines. No greetings, no commentary.
+""".strip()
+
 
 def init_ai():
     global openai_client
+    if openai_client:
+        return
     if OPENAI_API_KEY:
         try:
-            openai_client = OpenAI(api_key=OPENAI_API_KEY)
+            openai_client = OpenAI(
+                api_key=OPENAI_API_KEY,
+                timeout=OPENAI_TIMEOUT_SECONDS,
+                max_retries=OPENAI_MAX_RETRIES,
+                http_client=httpx.Client(
+                    timeout=OPENAI_TIMEOUT_SECONDS,
+                    follow_redirects=True,
+                    limits=httpx.Limits(
+                        max_connections=OPENAI_MAX_CONNECTIONS,
+                        max_keepalive_connections=OPENAI_MAX_CONNECTIONS,
+                        keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY_SECONDS,
+                    ),
+                ),
+            )
             print("OpenAI client initialized")
         except Exception as e:
             print("OpenAI init error:", repr(e))
@@ -21,11 +75,10 @@ def init_ai():
         print("Warning: OPENAI_API_KEY not set — AI replies disabled")
 
 
-def _build_system_prompt(clinic: dict):
-    clinic_name = clinic.get("name") or CLINIC_NAME
-
-    return f"""
-You are a polite, professional, and friendly dental clinic receptionist for {clinic_name}.
+# Identical for every clinic so OpenAI's prompt cache can reuse the prefix;
+# the clinic name goes in a second system message right after it.
+SYSTEM_PROMPT_STATIC = f"""
+You are a polite, professional, and friendly dental clinic receptionist for the clinic named in the next system message.
 
 Guidelines:
 - Greet patients warmly and naturally
@@ -48,7 +101,6 @@ If the patient wants to book:
 - Confirm before booking
 """.strip()
 
-
 def ai_reply(clinic: dict, user: str, msg: str):
     clinic_id = clinic.get("id")
     clinic_name = clinic.get("name") or CLINIC_NAME
@@ -56,25 +108,148 @@ def ai_reply(clinic: dict, user: str, msg: str):
     if not openai_client:
         return f"This is {clinic_name}. How may we help you today?"
 
+    # Static system prompt stays first and byte-identical so OpenAI's prompt cache applies
     messages = [
-        {"role": "system", "content": _build_system_prompt(clinic)}
+        {"role": "system", "content": SYSTEM_PROMPT_STATIC},
+        {"role": "system", "content": f"Clinic: {clinic_name}"},
     ]
 
-    # Keep conversation memory EXACTLY as before
-    messages += load_recent_messages(clinic_id, user)
+    summary, upto_id = load_conversation_summary(clinic_id, user)
+    history = load_recent_messages(clinic_id, user, limit=HISTORY_LIMIT, after_id=upto_id)
+
+    # routes.py saves the inbound message before calling us; don't send it twice
+    if history and history[-1] == {"role": "user", "content": msg}:
+        history.pop()
+
+    backlog = len(history)
+    history = _trim_history(history, HISTORY_CHAR_BUDGET - len(msg))
+
+    if summary:
+        messages.append({"role": "system", "content": f"Summary of the earlier conversation:\n{summary}"})
+    messages += history
     messages.append({"role": "user", "content": msg})
 
+    last_assistant = next((m["content"] for m in reversed(history) if m.get("role") == "assistant"), "")
+    cache_key = _reply_cache_key(clinic_id, clinic_name, summary, last_assistant, msg)
+    reply = _reply_cache_get(cache_key)
+
+    if reply is None:
+        try:
+            res = openai_client.chat.completions.create(
+                model="gpt-4o-mini",
+                messages=messages,
+                max_tokens=250,
+                temperature=0.6
+            )
+            reply = res.choices[0].message.content.strip()
+            _log_cached_tokens(res)
+        except Exception as e:
+            print("AI error:", repr(e))
+            return "Sorry, something went wrong. Please try again."
+        _reply_cache_put(cache_key, reply)
+
+    if backlog >= HISTORY_LIMIT - 1:
+        _request_history_summary(clinic_id, user)
+
+    return reply
+
+
+def _log_cached_tokens(res):
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+    usage = getattr(res, "usage", None)
+    details = getattr(usage, "prompt_tokens_details", None)
+    logger.debug(
+        "AI usage: prompt_tokens=%s cached_tokens=%s",
+        getattr(usage, "prompt_tokens", None),
+        getattr(details, "cached_tokens", None)
+    )
+
+
+def _reply_cache_key(clinic_id, clinic_name: str, summary: str, last_assistant: str, msg: str) -> str:
+    # clinic_id, not just the name: clinics can share a (default) CLINIC_NAME but
+    # not their prices or hours. The name stays in so a rename misses too.
+    question = " ".join((msg or "").lower().split())
+    raw = "\x1f".join([str(clinic_id or ""), clinic_name or "", summary or "", last_assistant or "", question])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def _reply_cache_get(key: str):
+    with _reply_cache_lock:
+        hit = _reply_cache.get(key)
+        if not hit:
+            return None
+        if time.monotonic() - hit[1] > REPLY_CACHE_TTL_SECONDS:
+            _reply_cache.pop(key, None)
+            return None
+        return hit[0]
+
+
+def _reply_cache_put(key: str, reply: str):
+    with _reply_cache_lock:
+        if key not in _reply_cache and len(_reply_cache) >= REPLY_CACHE_MAX:
+            # Oldest insert goes first (dicts keep insertion order)
+            _reply_cache.pop(next(iter(_reply_cache)))
+        _reply_cache[key] = (reply, time.monotonic())
+
+
+def _trim_history(history, budget: int):
+    """
+    Keeps the newest messages whose combined content fits in `budget` characters.
+    """
+    kept = []
+    used = 0
+    for m in reversed(history):
+        used += len(m.get("content") or "")
+        if used > budget:
+            break
+        kept.append(m)
+    kept.reverse()
+    return kept
+
+
+def _request_history_summary(clinic_id, user: str):
+    """
+    Queues a summarize_history job (handled by worker.py) once the unsummarized
+    backlog fills the history window.
+    """
     try:
-        res = openai_client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=messages,
-            max_tokens=250,
-            temperature=0.6
-        )
-        return res.choices[0].message.content.strip()
+        if not has_pending_job_for_user("summarize_history", clinic_id, user,
+                                        failed_within_minutes=SUMMARY_RETRY_AFTER_MINUTES):
+            enqueue_job("summarize_history", {"clinic_id": str(clinic_id), "user": user}, max_attempts=3)
     except Exception as e:
-        print("AI error:", repr(e))
-        return "Sorry, something went wrong. Please try again."
+        print("Summary enqueue failed:", repr(e))
+
+
+def summarize_history(clinic_id, user: str) -> bool:
+    """
+    Folds all but the latest SUMMARY_KEEP_RECENT messages into the stored summary,
+    so later replies send [system, summary, recent turns, user] instead of raw history.
+    """
+    if not openai_client:
+        return True
+
+    summary, upto_id = load_conversation_summary(clinic_id, user)
+    # Only the newest 2 * HISTORY_LIMIT are read; anything older than that is
+    # skipped, since upto_id moves past it once this batch is saved
+    rows = load_messages_after(clinic_id, user, upto_id, limit=2 * HISTORY_LIMIT)
+    older = rows[:-SUMMARY_KEEP_RECENT]
+    if not older:
+        return True
+
+    transcript = "\n".join(f"{role}: {content}" for _, role, content in older)
+    res = openai_client.chat.completions.create(
+        model="gpt-4o-mini",
+        messages=[
+            {"role": "system", "content": SUMMARY_PROMPT},
+            {"role": "user", "content": f"Existing summary:\n{summary or '(none)'}\n\nNew messages:\n{transcript}"},
+        ],
+        max_tokens=200,
+        temperature=0
+    )
+    new_summary = res.choices[0].message.content.strip()
+    save_conversation_summary(clinic_id, user, new_summary, older[-1][0])
+    return True
 
 
 def ai_extract_booking_signal(clinic: dict, user_text: str):
@@ -155,7 +330,7 @@ Examples of booking intent:
         )
 
         raw = res.choices[0].message.content.strip()
-        print("EXTRACT RAW:", raw)
+        logger.debug("EXTRACT RAW: %s", raw)
 
         data = json.loads(raw)
 
@@ -174,7 +349,7 @@ Examples of booking intent:
             "time": str(time).strip() if time else None,
         }
 
-        print("EXTRACT PARSED:", result)
+        logger.debug("EXTRACT PARSED: %s", result)
         return result
 
     except Exception as e:
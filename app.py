@@ -1,7 +1,16 @@
-import os
+# Under `gunicorn -k gevent` sockets are already monkey-patched; make psycopg2
+# yield to other greenlets too. No-op for the default gthread workers.
+try:
+    from gevent import monkey
+    if monkey.is_module_patched("socket"):
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+except ImportError:
+    pass
+
 from flask import Flask
 
-from config import CLINIC_NAME
+from config import CLINIC_NAME, FLASK_SECRET_KEY, PORT, DB_INIT_ON_START, USE_DEV_SERVER
 from db import init_db
 from sheets import init_sheets
 from ai import init_ai
@@ -11,7 +20,8 @@ from admin_dashboard import register_admin_dashboard
 # -------------------------------------------------
 # Bootstrap (keeps your init behavior)
 # -------------------------------------------------
-init_db()
+if DB_INIT_ON_START:
+    init_db()
 init_sheets()
 init_ai()
 
@@ -19,7 +29,7 @@ init_ai()
 # Flask App
 # -------------------------------------------------
 app = Flask(__name__)
-app.secret_key = os.getenv("FLASK_SECRET_KEY", "change-this-secret-key")
+app.secret_key = FLASK_SECRET_KEY
 register_routes(app)
 register_admin_dashboard(app)
 
@@ -27,6 +37,10 @@ register_admin_dashboard(app)
 # Run
 # -------------------------------------------------
 if __name__ == "__main__":
-    port = int(os.environ.get("PORT", 5000))
-    print(f"Starting {CLINIC_NAME} bot on port {port}...")
-    app.run(host="0.0.0.0", port=port, debug=False)
+    if not USE_DEV_SERVER:
+        raise SystemExit(
+            "Run under gunicorn: gunicorn app:app --worker-class gthread --threads 8 "
+            "(set USE_DEV_SERVER=1 for the local dev server)"
+        )
+    print(f"Starting {CLINIC_NAME} bot on port {PORT} (dev server)...")
+    app.run(host="0.0.0.0", port=PORT, debug=False, threaded=True)
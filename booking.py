@@ -1,16 +1,21 @@
 import secrets
 import string
 import datetime
+import logging
 
-import psycopg2
+from db import get_conn
 
-from sheets import sheets_api, a1, get_sheet_header_map, _col_to_idx
-from config import GOOGLE_SHEETS_ID, SHEET_TAB, DEFAULT_SHEET_ID, DEFAULT_SHEET_TAB
-from db import db_conn
-from hours import normalize_time_to_24h
+
+logger = logging.getLogger("booking")
+
+
+class SlotTakenError(Exception):
+    """Raised by save_appointment_local when another Booked row holds the slot."""
 
 
 def log_booking(tag, **kwargs):
+    if not logger.isEnabledFor(logging.INFO):
+        return
     try:
         parts = [f"[{tag}]"]
         for k, v in kwargs.items():
@@ -18,34 +23,13 @@ def log_booking(tag, **kwargs):
             if len(v) > 300:
                 v = v[:300] + "..."
             parts.append(f"{k}={v}")
-        print(" | ".join(parts))
+        logger.info(" | ".join(parts))
     except Exception as e:
-        print(f"[BOOKING_LOG_FAILED] tag={tag} error={repr(e)}")
-
-
-def _normalize_sheet_date(value):
-    if value is None:
-        return ""
-    s = str(value).strip()
-
-    try:
-        dt = datetime.datetime.strptime(s, "%Y-%m-%d")
-        return dt.strftime("%Y-%m-%d")
-    except Exception:
-        pass
-
-    for fmt in ("%d/%m/%Y", "%d-%m-%Y", "%d/%m/%y", "%d-%m-%y", "%Y/%m/%d"):
-        try:
-            dt = datetime.datetime.strptime(s, fmt)
-            return dt.strftime("%Y-%m-%d")
-        except Exception:
-            pass
-
-    return s
+        logger.warning("[BOOKING_LOG_FAILED] tag=%s error=%r", tag, e)
 
 
 # -------------------------------------------------
-# Double booking check (DB + Google Sheets)
+# Double booking check (DB)
 # -------------------------------------------------
 def check_double_booking(clinic_id, date, time, sheet_id=None, sheet_tab=None):
     log_booking(
@@ -57,14 +41,12 @@ def check_double_booking(clinic_id, date, time, sheet_id=None, sheet_tab=None):
         sheet_tab=sheet_tab or ""
     )
 
-    conn = db_conn()
-    c = conn.cursor()
-    c.execute(
-        "SELECT id FROM appointments WHERE clinic_id=%s AND date=%s AND time=%s AND status='Booked'",
-        (clinic_id, date, time)
-    )
-    exists = c.fetchone()
-    conn.close()
+    with get_conn() as conn, conn.cursor() as c:
+        c.execute(
+            "SELECT id FROM appointments WHERE clinic_id=%s AND date=%s AND time=%s AND status='Booked'",
+            (clinic_id, date, time)
+        )
+        exists = c.fetchone()
 
     if exists:
         log_booking(
@@ -76,156 +58,12 @@ def check_double_booking(clinic_id, date, time, sheet_id=None, sheet_tab=None):
         )
         return True
 
-    if not sheets_api:
-        log_booking(
-            "DOUBLE_BOOKING_SHEETS_SKIPPED",
-            clinic_id=clinic_id,
-            date=date,
-            time=time,
-            reason="sheets_api_not_initialized"
-        )
-        return False
-
-    sid = (sheet_id or GOOGLE_SHEETS_ID or DEFAULT_SHEET_ID or "").strip()
-    tab = (sheet_tab or SHEET_TAB or DEFAULT_SHEET_TAB or "Sheet1").strip()
-
-    if not sid:
-        log_booking(
-            "DOUBLE_BOOKING_SHEETS_SKIPPED",
-            clinic_id=clinic_id,
-            date=date,
-            time=time,
-            reason="missing_spreadsheet_id"
-        )
-        return False
-
-    try:
-        header_map = get_sheet_header_map(sid, tab)
-        log_booking(
-            "DOUBLE_BOOKING_SHEETS_HEADER_MAP",
-            clinic_id=clinic_id,
-            date=date,
-            time=time,
-            spreadsheet_id_present=bool(sid),
-            tab=tab,
-            has_header_map=bool(header_map),
-            header_keys=list(header_map.keys()) if header_map else []
-        )
-
-        if header_map and "date" in header_map and "time" in header_map:
-            date_i = _col_to_idx(header_map["date"])
-            time_i = _col_to_idx(header_map["time"])
-
-            status_i = None
-            if "status" in header_map:
-                status_i = _col_to_idx(header_map["status"])
-
-            res = sheets_api.values().get(
-                spreadsheetId=sid,
-                range=a1(tab, "A2:Z")
-            ).execute()
-
-            rows = res.get("values", [])
-            log_booking(
-                "DOUBLE_BOOKING_SHEETS_ROWS_FETCHED",
-                clinic_id=clinic_id,
-                date=date,
-                time=time,
-                tab=tab,
-                rows_count=len(rows),
-                mode="header_map"
-            )
-
-            for idx, row in enumerate(rows):
-                d = row[date_i] if len(row) > date_i else ""
-                t = row[time_i] if len(row) > time_i else ""
-                status = row[status_i] if status_i is not None and len(row) > status_i else ""
-
-                d_norm = _normalize_sheet_date(d)
-                t_norm = normalize_time_to_24h(str(t).strip()) if t else ""
-
-                if status_i is not None and str(status).strip().lower() in {"cancelled", "rescheduled"}:
-                    continue
-
-                if d_norm == date and t_norm == time:
-                    log_booking(
-                        "DOUBLE_BOOKING_SHEETS_HIT",
-                        clinic_id=clinic_id,
-                        date=date,
-                        time=time,
-                        tab=tab,
-                        row_index=idx + 2,
-                        matched_date=d_norm,
-                        matched_time=t_norm,
-                        status=status
-                    )
-                    return True
-
-            log_booking(
-                "DOUBLE_BOOKING_NOT_FOUND",
-                clinic_id=clinic_id,
-                date=date,
-                time=time,
-                checked_db=True,
-                checked_sheets=True
-            )
-            return False
-
-        res = sheets_api.values().get(
-            spreadsheetId=sid,
-            range=a1(tab, "A2:Z")
-        ).execute()
-
-        rows = res.get("values", [])
-        log_booking(
-            "DOUBLE_BOOKING_SHEETS_ROWS_FETCHED",
-            clinic_id=clinic_id,
-            date=date,
-            time=time,
-            tab=tab,
-            rows_count=len(rows),
-            mode="fallback_columns"
-        )
-
-        for idx, row in enumerate(rows):
-            d = row[0] if len(row) > 0 else ""
-            t = row[1] if len(row) > 1 else ""
-
-            d_norm = _normalize_sheet_date(d)
-            t_norm = normalize_time_to_24h(str(t).strip()) if t else ""
-
-            if d_norm == date and t_norm == time:
-                log_booking(
-                    "DOUBLE_BOOKING_SHEETS_HIT",
-                    clinic_id=clinic_id,
-                    date=date,
-                    time=time,
-                    tab=tab,
-                    row_index=idx + 2,
-                    matched_date=d_norm,
-                    matched_time=t_norm,
-                    mode="fallback_columns"
-                )
-                return True
-
-    except Exception as e:
-        log_booking(
-            "DOUBLE_BOOKING_SHEETS_ERROR",
-            clinic_id=clinic_id,
-            date=date,
-            time=time,
-            spreadsheet_id_present=bool(sid),
-            tab=tab,
-            error=repr(e)
-        )
-
     log_booking(
         "DOUBLE_BOOKING_NOT_FOUND",
         clinic_id=clinic_id,
         date=date,
         time=time,
-        checked_db=True,
-        checked_sheets=True
+        checked_db=True
     )
     return False
 
@@ -233,20 +71,23 @@ def check_double_booking(clinic_id, date, time, sheet_id=None, sheet_tab=None):
 # -------------------------------------------------
 # Appointment reference code
 # -------------------------------------------------
+_REF_ALPHABET = string.ascii_uppercase + string.digits
+
+
 def generate_ref_code():
-    alphabet = string.ascii_uppercase + string.digits
-    ref_code = "AP-" + "".join(secrets.choice(alphabet) for _ in range(6))
+    ref_code = "AP-" + "".join([secrets.choice(_REF_ALPHABET) for _ in range(6)])
     log_booking("REF_CODE_GENERATED", ref_code=ref_code)
     return ref_code
 
 
-def save_appointment_local(clinic_id, user, name, date, time, source_message_sid=None):
+def save_appointment_local(clinic_id, user, name, date, time, source_message_sid=None, created_at=None):
     """
     Saves and returns (appt_id, ref_code).
 
     Retries only on rare ref_code collision.
     Prevents duplicate appointment creation from the same inbound confirmation
     when source_message_sid is provided.
+    Raises SlotTakenError when another Booked row already holds the slot.
     """
     log_booking(
         "SAVE_APPOINTMENT_START",
@@ -258,12 +99,12 @@ def save_appointment_local(clinic_id, user, name, date, time, source_message_sid
         source_message_sid=source_message_sid or ""
     )
 
-    for attempt in range(1, 6):
-        ref_code = generate_ref_code()
-        conn = None
-        try:
-            conn = db_conn()
-            c = conn.cursor()
+    with get_conn() as conn, conn.cursor() as c:
+        for attempt in range(1, 6):
+            ref_code = generate_ref_code()
+            # DO NOTHING covers every unique index (ref_code, source_message_sid,
+            # booked slot); a conflict comes back as no row instead of an
+            # exception, so the transaction stays usable for the checks below.
             c.execute(
                 """
                 INSERT INTO appointments
@@ -273,6 +114,7 @@ def save_appointment_local(clinic_id, user, name, date, time, source_message_sid
                     ref_code, source_message_sid
                 )
                 VALUES (%s,%s,%s,%s,%s,'Booked','WhatsApp',%s,'pending',%s,%s)
+                ON CONFLICT DO NOTHING
                 RETURNING id
                 """,
                 (
@@ -281,79 +123,28 @@ def save_appointment_local(clinic_id, user, name, date, time, source_message_sid
                     name,
                     date,
                     time,
-                    datetime.datetime.utcnow(),
+                    created_at or datetime.datetime.utcnow(),
                     ref_code,
                     source_message_sid,
                 )
             )
-            appt_id = c.fetchone()[0]
-            conn.commit()
-            conn.close()
-
-            log_booking(
-                "SAVE_APPOINTMENT_SUCCESS",
-                clinic_id=clinic_id,
-                user=user,
-                appointment_id=appt_id,
-                ref_code=ref_code,
-                attempt=attempt,
-                source_message_sid=source_message_sid or ""
-            )
-            return appt_id, ref_code
-
-        except psycopg2.Error as e:
-            pgcode = getattr(e, "pgcode", None)
-            constraint_name = getattr(getattr(e, "diag", None), "constraint_name", "") or ""
-
-            log_booking(
-                "SAVE_APPOINTMENT_DB_ERROR",
-                clinic_id=clinic_id,
-                user=user,
-                attempt=attempt,
-                ref_code=ref_code,
-                pgcode=pgcode,
-                constraint_name=constraint_name,
-                error=repr(e),
-                source_message_sid=source_message_sid or ""
-            )
-
-            try:
-                if conn:
-                    conn.rollback()
-                    conn.close()
-            except Exception as close_err:
-                log_booking(
-                    "SAVE_APPOINTMENT_CONN_CLOSE_ERROR",
-                    clinic_id=clinic_id,
-                    user=user,
-                    attempt=attempt,
-                    error=repr(close_err)
-                )
-
-            # Retry only if the generated reference code collided
-            if pgcode == "23505" and constraint_name == "uq_appointments_ref_code":
+            row = c.fetchone()
+            if row:
                 log_booking(
-                    "SAVE_APPOINTMENT_REF_COLLISION",
+                    "SAVE_APPOINTMENT_SUCCESS",
                     clinic_id=clinic_id,
                     user=user,
+                    appointment_id=row[0],
+                    ref_code=ref_code,
                     attempt=attempt,
-                    ref_code=ref_code
+                    source_message_sid=source_message_sid or ""
                 )
-                continue
+                return row[0], ref_code
 
-            # If the same confirmation message tries to create another appointment,
-            # return the already-created appointment instead of making a new one.
-            if pgcode == "23505" and constraint_name == "uq_appointments_source_message_sid" and source_message_sid:
-                log_booking(
-                    "SAVE_APPOINTMENT_DUPLICATE_SOURCE_SID",
-                    clinic_id=clinic_id,
-                    user=user,
-                    source_message_sid=source_message_sid
-                )
-
-                conn2 = db_conn()
-                c2 = conn2.cursor()
-                c2.execute(
+            # If the same confirmation message already created an appointment,
+            # return it instead of making a new one (webhook retry).
+            if source_message_sid:
+                c.execute(
                     """
                     SELECT id, ref_code
                     FROM appointments
@@ -362,21 +153,40 @@ def save_appointment_local(clinic_id, user, name, date, time, source_message_sid
                     """,
                     (source_message_sid,)
                 )
-                row = c2.fetchone()
-                conn2.close()
-
-                if row:
+                existing = c.fetchone()
+                if existing:
                     log_booking(
                         "SAVE_APPOINTMENT_EXISTING_RETURNED",
                         clinic_id=clinic_id,
                         user=user,
-                        appointment_id=row[0],
-                        ref_code=row[1],
+                        appointment_id=existing[0],
+                        ref_code=existing[1],
                         source_message_sid=source_message_sid
                     )
-                    return row[0], row[1]
+                    return existing[0], existing[1]
 
-            raise
+            c.execute(
+                "SELECT 1 FROM appointments WHERE clinic_id=%s AND date=%s AND time=%s AND status='Booked' LIMIT 1",
+                (clinic_id, date, time)
+            )
+            if c.fetchone():
+                log_booking(
+                    "SAVE_APPOINTMENT_SLOT_TAKEN",
+                    clinic_id=clinic_id,
+                    user=user,
+                    date=date,
+                    time=time
+                )
+                raise SlotTakenError(f"{date} {time} is already booked")
+
+            # Only the generated reference code is left to have collided
+            log_booking(
+                "SAVE_APPOINTMENT_REF_COLLISION",
+                clinic_id=clinic_id,
+                user=user,
+                attempt=attempt,
+                ref_code=ref_code
+            )
 
     log_booking(
         "SAVE_APPOINTMENT_FAILED",
@@ -385,4 +195,4 @@ def save_appointment_local(clinic_id, user, name, date, time, source_message_sid
         reason="exhausted_ref_code_attempts",
         source_message_sid=source_message_sid or ""
     )
-    raise RuntimeError("Failed to generate a unique appointment reference. Try again.")
\ No newline at end of file
+    raise RuntimeError("Failed to generate a unique appointment reference. Try again.")
@@ -1,28 +1,56 @@
+import time
 from zoneinfo import ZoneInfo
 
 from config import GOOGLE_SHEETS_ID, SHEET_TAB, DEFAULT_SHEET_ID, DEFAULT_SHEET_TAB
-from db import db_conn
+from db import get_conn, _parse_settings_value
+
+
+# Twilio "To" number -> (clinic_id, settings, fetched_at). Channel mappings and
+# settings change rarely; entries expire after CLINIC_CACHE_TTL_SECONDS so edits
+# made from another process still land, and clear_clinic_cache() drops them here.
+CLINIC_CACHE_TTL_SECONDS = 300
+_clinic_by_number = {}
+
+
+def clear_clinic_cache():
+    _clinic_by_number.clear()
 
 
 def resolve_clinic_id(to_number: str):
+    return resolve_clinic(to_number)[0]
+
+
+def resolve_clinic(to_number: str):
+    """
+    Resolves the Twilio "To" number and loads that clinic's settings in one
+    round-trip. Returns (clinic_id, settings) or (None, {}).
+    """
+    cached = _clinic_by_number.get(to_number)
+    if cached and time.monotonic() - cached[2] < CLINIC_CACHE_TTL_SECONDS:
+        return cached[0], cached[1]
+
     try:
-        conn = db_conn()
-        c = conn.cursor()
-        c.execute(
-            """
-            select clinic_id
-            from channels
-            where provider='twilio' and to_number=%s and is_active=true
-            limit 1
-            """,
-            (to_number,)
-        )
-        row = c.fetchone()
-        conn.close()
-        return row[0] if row else None
+        with get_conn() as conn, conn.cursor() as c:
+            c.execute(
+                """
+                select ch.clinic_id, cs.settings
+                from channels ch
+                left join clinic_settings cs on cs.clinic_id = ch.clinic_id
+                where ch.provider='twilio' and ch.to_number=%s and ch.is_active=true
+                limit 1
+                """,
+                (to_number,)
+            )
+            row = c.fetchone()
+        if not row:
+            _clinic_by_number.pop(to_number, None)
+            return None, {}
+        settings = _parse_settings_value(row[1])
+        _clinic_by_number[to_number] = (row[0], settings, time.monotonic())
+        return row[0], settings
     except Exception as e:
-        print("resolve_clinic_id FAILED:", repr(e))
-        return None
+        print("resolve_clinic FAILED:", repr(e))
+        return None, {}
 
 
 def _default_twilio_settings():
@@ -3,14 +3,16 @@ import re
 import psycopg2
 import psycopg2.extras
 
-from db import db_conn
-from clinic import validate_clinic_settings
+from db import get_conn
+from clinic import validate_clinic_settings, clear_clinic_cache
+
+_WS_RE = re.compile(r"\s+")
 
 
 def _normalize_whatsapp_number(number: str) -> str:
     s = str(number or "").strip()
     s = s.replace("whatsapp:", "").strip()
-    s = re.sub(r"\s+", "", s)
+    s = _WS_RE.sub("", s)
 
     if not s:
         raise ValueError("WhatsApp number is required")
@@ -130,10 +132,7 @@ def create_clinic_only(
         twilio=twilio,
     )
 
-    conn = db_conn()
-    try:
-        c = conn.cursor()
-
+    with get_conn() as conn, conn.cursor() as c:
         c.execute(
             """
             INSERT INTO clinics (name)
@@ -155,22 +154,16 @@ def create_clinic_only(
             (clinic_id, psycopg2.extras.Json(cleaned_settings))
         )
 
-        conn.commit()
-
-        return {
-            "clinic_id": str(clinic_id),
-            "clinic_name": clinic_name,
-            "to_number": None,
-            "channel_attached": False,
-            "settings": cleaned_settings,
-            "warnings": warnings,
-        }
+    clear_clinic_cache()
 
-    except Exception:
-        conn.rollback()
-        raise
-    finally:
-        conn.close()
+    return {
+        "clinic_id": str(clinic_id),
+        "clinic_name": clinic_name,
+        "to_number": None,
+        "channel_attached": False,
+        "settings": cleaned_settings,
+        "warnings": warnings,
+    }
 
 
 def attach_channel_to_clinic(clinic_id: str, to_number: str):
@@ -179,10 +172,7 @@ def attach_channel_to_clinic(clinic_id: str, to_number: str):
     """
     normalized_to = _normalize_whatsapp_number(to_number)
 
-    conn = db_conn()
-    try:
-        c = conn.cursor()
-
+    with get_conn() as conn, conn.cursor() as c:
         c.execute(
             "SELECT id FROM clinics WHERE id=%s LIMIT 1",
             (clinic_id,)
@@ -202,19 +192,13 @@ def attach_channel_to_clinic(clinic_id: str, to_number: str):
             (clinic_id, normalized_to)
         )
 
-        conn.commit()
+    clear_clinic_cache()
 
-        return {
-            "clinic_id": str(clinic_id),
-            "to_number": normalized_to,
-            "channel_attached": True,
-        }
-
-    except Exception:
-        conn.rollback()
-        raise
-    finally:
-        conn.close()
+    return {
+        "clinic_id": str(clinic_id),
+        "to_number": normalized_to,
+        "channel_attached": True,
+    }
 
 
 def onboard_clinic(
@@ -291,10 +275,7 @@ def update_existing_clinic_setup(
 
     normalized_to = _normalize_whatsapp_number(to_number) if to_number else None
 
-    conn = db_conn()
-    try:
-        c = conn.cursor()
-
+    with get_conn() as conn, conn.cursor() as c:
         c.execute(
             """
             UPDATE clinics
@@ -327,19 +308,13 @@ def update_existing_clinic_setup(
             (clinic_id, psycopg2.extras.Json(cleaned_settings))
         )
 
-        conn.commit()
+    clear_clinic_cache()
 
-        return {
-            "clinic_id": str(clinic_id),
-            "clinic_name": clinic_name,
-            "to_number": normalized_to,
-            "channel_attached": bool(normalized_to),
-            "settings": cleaned_settings,
-            "warnings": warnings,
-        }
-
-    except Exception:
-        conn.rollback()
-        raise
-    finally:
-        conn.close()
\ No newline at end of file
+    return {
+        "clinic_id": str(clinic_id),
+        "clinic_name": clinic_name,
+        "to_number": normalized_to,
+        "channel_attached": bool(normalized_to),
+        "settings": cleaned_settings,
+        "warnings": warnings,
+    }
\ No newline at end of file
@@ -1,18 +1,17 @@
 import json
 import psycopg2.extras
 
-from db import db_conn
+from db import get_conn
+from clinic import clear_clinic_cache
 
 
 def get_clinic_settings(clinic_id: str) -> dict:
-    conn = db_conn()
-    c = conn.cursor()
-    c.execute(
-        "SELECT settings FROM clinic_settings WHERE clinic_id = %s",
-        (clinic_id,)
-    )
-    row = c.fetchone()
-    conn.close()
+    with get_conn() as conn, conn.cursor() as c:
+        c.execute(
+            "SELECT settings FROM clinic_settings WHERE clinic_id = %s",
+            (clinic_id,)
+        )
+        row = c.fetchone()
 
     if not row:
         return {}
@@ -34,19 +33,18 @@ def save_clinic_settings(clinic_id: str, settings: dict):
     if not isinstance(settings, dict):
         raise ValueError("settings must be a dict")
 
-    conn = db_conn()
-    c = conn.cursor()
-    c.execute(
-        """
-        INSERT INTO clinic_settings (clinic_id, settings)
-        VALUES (%s, %s)
-        ON CONFLICT (clinic_id)
-        DO UPDATE SET settings = EXCLUDED.settings, updated_at = NOW()
-        """,
-        (clinic_id, psycopg2.extras.Json(settings))
-    )
-    conn.commit()
-    conn.close()
+    with get_conn() as conn, conn.cursor() as c:
+        c.execute(
+            """
+            INSERT INTO clinic_settings (clinic_id, settings)
+            VALUES (%s, %s)
+            ON CONFLICT (clinic_id)
+            DO UPDATE SET settings = EXCLUDED.settings, updated_at = NOW()
+            """,
+            (clinic_id, psycopg2.extras.Json(settings))
+        )
+    # Committed above; resolve_clinic caches settings alongside the clinic id
+    clear_clinic_cache()
 
 
 def _default_twilio_settings() -> dict:
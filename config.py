@@ -1,4 +1,6 @@
 import os
+import sys
+import logging
 from dotenv import load_dotenv
 
 # -------------------------------------------------
@@ -6,10 +8,13 @@ from dotenv import load_dotenv
 # -------------------------------------------------
 load_dotenv()
 
-print("LOCAL DATABASE_URL exists?", bool(os.getenv("DATABASE_URL")))
-print("LOCAL SERVICE_ACCOUNT_JSON exists?", bool(os.getenv("SERVICE_ACCOUNT_JSON")))
-print("LOCAL SERVICE_ACCOUNT_FILE exists?", bool(os.getenv("SERVICE_ACCOUNT_FILE")))
-print("LOCAL GOOGLE_SHEETS_ID exists?", bool(os.getenv("GOOGLE_SHEETS_ID")))
+# -------------------------------------------------
+# Logging (per-request trace lines are DEBUG; set LOG_LEVEL=DEBUG to see them)
+# -------------------------------------------------
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").strip().upper() or "INFO"
+if not isinstance(logging.getLevelName(LOG_LEVEL), int):
+    LOG_LEVEL = "INFO"  # unknown names would make basicConfig raise at import
+logging.basicConfig(stream=sys.stdout, level=LOG_LEVEL, format="%(message)s")
 
 # -------------------------------------------------
 # Google Sheets (Local file OR Render-safe JSON)
@@ -19,9 +24,16 @@ SERVICE_FILE = os.getenv("SERVICE_ACCOUNT_FILE", "").strip()
 GOOGLE_SHEETS_ID = os.getenv("GOOGLE_SHEETS_ID", "").strip()
 SHEET_TAB = os.getenv("GOOGLE_SHEETS_TAB", "Sheet1").strip()
 
+print("LOCAL SERVICE_ACCOUNT_JSON exists?", bool(SERVICE_JSON))
+print("LOCAL SERVICE_ACCOUNT_FILE exists?", bool(SERVICE_FILE))
+print("LOCAL GOOGLE_SHEETS_ID exists?", bool(GOOGLE_SHEETS_ID))
+
 DEFAULT_SHEET_ID = "15W9oICScP7ecJvacczeuCmlHVAvJ2QmVSH9tJgSiQBo"
 DEFAULT_SHEET_TAB = "Sheet1"
 
+# Socket timeout for Sheets calls (httplib2 default is to wait forever)
+SHEETS_HTTP_TIMEOUT_SECONDS = float(os.getenv("SHEETS_HTTP_TIMEOUT_SECONDS", "10"))
+
 # -------------------------------------------------
 # Environment variables
 # -------------------------------------------------
@@ -30,7 +42,41 @@ TWILIO_WHATSAPP_NUMBER = os.getenv("TWILIO_WHATSAPP_NUMBER", "whatsapp:+14155238
 ADMIN_WHATSAPP = os.getenv("ADMIN_WHATSAPP", "").strip()
 CLINIC_NAME = os.getenv("CLINIC_NAME", "PrimeCare Dental Clinic")
 
+# Twilio gives up on a webhook after ~15s. An idle turn makes two sequential calls
+# (booking-signal extraction, then the reply), each worst case
+# timeout * (retries + 1): 5s x 2 calls with no retries stays under ~12s.
+OPENAI_TIMEOUT_SECONDS = float(os.getenv("OPENAI_TIMEOUT_SECONDS", "5"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "0"))
+# One shared HTTP pool per process. httpx drops idle connections after 5s by
+# default, so sparse chat traffic would pay a fresh TLS handshake per reply.
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "20"))
+OPENAI_KEEPALIVE_EXPIRY_SECONDS = float(os.getenv("OPENAI_KEEPALIVE_EXPIRY_SECONDS", "60"))
+
+# -------------------------------------------------
+# Web app (read once here; nothing reads os.environ per request)
+# -------------------------------------------------
+FLASK_SECRET_KEY = os.getenv("FLASK_SECRET_KEY", "change-this-secret-key")
+DASHBOARD_PASSWORD = os.getenv("DASHBOARD_PASSWORD", "").strip()
+PORT = int(os.getenv("PORT", "5000"))
+# `python app.py` only starts the Werkzeug dev server when this is set;
+# production runs under gunicorn (see Procfile)
+USE_DEV_SERVER = os.getenv("USE_DEV_SERVER", "0").strip() == "1"
+
 # -------------------------------------------------
 # Database (PostgreSQL ONLY)
 # -------------------------------------------------
 DATABASE_URL = os.getenv("DATABASE_URL", "").strip()
+print("LOCAL DATABASE_URL exists?", bool(DATABASE_URL))
+
+# Set to 0 on web processes once the schema is in place (e.g. run init_db from
+# a release/worker process only)
+DB_INIT_ON_START = os.getenv("DB_INIT_ON_START", "1").strip() == "1"
+
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+
+# Behind PgBouncer (transaction pooling) keep DB_POOL_MAX small per worker and
+# point DATABASE_URL at the bouncer; queries use plain %s binds, no PREPARE.
+# Statement timeout is sent as a startup option, so PgBouncer needs
+# ignore_startup_parameters = options (or leave this at 0).
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "0"))
@@ -1,24 +1,135 @@
 import datetime
 import json
+import threading
+from contextlib import contextmanager
 
 import psycopg2
 import psycopg2.extras
-from psycopg2 import IntegrityError
+from psycopg2 import pool as pg_pool
+
+from config import DATABASE_URL, DB_POOL_MIN, DB_POOL_MAX, DB_STATEMENT_TIMEOUT_MS
+
+
+_pg_pool = None
+_pg_pool_lock = threading.Lock()
+
+# ThreadedConnectionPool raises PoolError once DB_POOL_MAX connections are out;
+# borrowers wait on this instead (cooperatively under gevent's monkey-patching)
+_pool_slots = threading.BoundedSemaphore(DB_POOL_MAX)
+
+
+def _get_pool():
+    global _pg_pool
+    if _pg_pool is None:
+        with _pg_pool_lock:
+            if _pg_pool is None:
+                if not DATABASE_URL:
+                    raise RuntimeError("DATABASE_URL is not set. This app now requires Postgres.")
+                extra = {}
+                if DB_STATEMENT_TIMEOUT_MS > 0:
+                    extra["options"] = f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"
+                _pg_pool = pg_pool.ThreadedConnectionPool(
+                    DB_POOL_MIN,
+                    DB_POOL_MAX,
+                    DATABASE_URL,
+                    keepalives=1,
+                    keepalives_idle=30,
+                    **extra
+                )
+                print(f"DB: USING POSTGRESQL (pool min={DB_POOL_MIN} max={DB_POOL_MAX})")
+    return _pg_pool
+
+
+class _PooledConnection:
+    """
+    Proxy around a pooled psycopg2 connection.
+    close() hands the connection back to the pool instead of dropping the socket,
+    so existing `conn = db_conn() ... conn.close()` call sites keep working.
+    """
+
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
 
-from config import DATABASE_URL
+    def close(self):
+        conn, self._conn = self._conn, None
+        if conn is not None:
+            try:
+                self._pool.putconn(conn)
+            finally:
+                _pool_slots.release()
 
 
 def db_conn():
-    if not DATABASE_URL:
-        raise RuntimeError("DATABASE_URL is not set. This app now requires Postgres.")
-    print("DB: USING POSTGRESQL")
-    return psycopg2.connect(DATABASE_URL)
+    pool = _get_pool()
+    _pool_slots.acquire()
+    try:
+        return _PooledConnection(pool, pool.getconn())
+    except Exception:
+        _pool_slots.release()
+        raise
+
+
+@contextmanager
+def get_conn():
+    """
+    Borrow a pooled connection for the duration of a `with` block.
+    Commits on success, rolls back on error, always returns it to the pool.
+    """
+    pool = _get_pool()
+    _pool_slots.acquire()
+    try:
+        conn = pool.getconn()
+    except Exception:
+        _pool_slots.release()
+        raise
+    try:
+        yield conn
+        conn.commit()
+    except Exception:
+        if not conn.closed:
+            conn.rollback()
+        raise
+    finally:
+        try:
+            pool.putconn(conn)
+        finally:
+            _pool_slots.release()
+
+
+_db_initialized = False
+
+# Arbitrary app-wide key; serializes init_db across gunicorn workers and dynos
+INIT_DB_LOCK_KEY = 0x57A7B07
+
+
+def _create_index_optional(c, name, ddl):
+    # Savepoint per index: a failed CREATE must not abort the rest of init_db's
+    # single (advisory-locked) transaction
+    c.execute("SAVEPOINT optional_idx")
+    try:
+        c.execute(ddl)
+        c.execute("RELEASE SAVEPOINT optional_idx")
+    except Exception as e:
+        c.execute("ROLLBACK TO SAVEPOINT optional_idx")
+        print(f"Index create {name} failed:", repr(e))
 
 
 def init_db():
+    global _db_initialized
+    if _db_initialized:
+        return
+
     conn = db_conn()
     c = conn.cursor()
 
+    # Held until the commit below: concurrent boots run the DDL one at a time
+    # instead of contending for the same table locks
+    c.execute("SELECT pg_advisory_xact_lock(%s)", (INIT_DB_LOCK_KEY,))
+
     c.execute("""
         CREATE TABLE IF NOT EXISTS messages (
             id SERIAL PRIMARY KEY,
@@ -31,22 +142,21 @@ def init_db():
         )
     """)
 
-    try:
-        c.execute("""
-            CREATE UNIQUE INDEX IF NOT EXISTS uq_messages_twilio_sid
-            ON messages (twilio_sid)
-            WHERE twilio_sid IS NOT NULL
-        """)
-    except Exception as e:
-        print("Index create uq_messages_twilio_sid failed:", repr(e))
+    _create_index_optional(c, "uq_messages_twilio_sid", """
+        CREATE UNIQUE INDEX IF NOT EXISTS uq_messages_twilio_sid
+        ON messages (twilio_sid)
+        WHERE twilio_sid IS NOT NULL
+    """)
 
-    try:
-        c.execute("""
-            CREATE INDEX IF NOT EXISTS idx_messages_clinic_user_created
-            ON messages (clinic_id, user_number, created_at)
-        """)
-    except Exception as e:
-        print("Index create idx_messages_clinic_user_created failed:", repr(e))
+    _create_index_optional(c, "idx_messages_clinic_user_created", """
+        CREATE INDEX IF NOT EXISTS idx_messages_clinic_user_created
+        ON messages (clinic_id, user_number, created_at)
+    """)
+
+    _create_index_optional(c, "idx_messages_clinic_user_id", """
+        CREATE INDEX IF NOT EXISTS idx_messages_clinic_user_id
+        ON messages (clinic_id, user_number, id DESC)
+    """)
 
     c.execute("""
         CREATE TABLE IF NOT EXISTS conversations (
@@ -78,14 +188,57 @@ def init_db():
         )
     """)
 
+    _create_index_optional(c, "uq_appointments_ref_code", """
+        CREATE UNIQUE INDEX IF NOT EXISTS uq_appointments_ref_code
+        ON appointments (clinic_id, ref_code)
+        WHERE ref_code IS NOT NULL
+    """)
+
+    c.execute("""
+        ALTER TABLE appointments
+        ADD COLUMN IF NOT EXISTS source_message_sid text
+    """)
+
+    _create_index_optional(c, "uq_appointments_source_message_sid", """
+        CREATE UNIQUE INDEX IF NOT EXISTS uq_appointments_source_message_sid
+        ON appointments (source_message_sid)
+        WHERE source_message_sid IS NOT NULL
+    """)
+
+    # One Booked row per slot, enforced by Postgres (booking.SlotTakenError).
+    # Savepoint: existing duplicate slots make this fail without aborting init_db;
+    # the plain lookup index is kept as a fallback until they are cleaned up.
     try:
+        c.execute("SAVEPOINT booked_slot_idx")
         c.execute("""
-            CREATE UNIQUE INDEX IF NOT EXISTS uq_appointments_ref_code
-            ON appointments (clinic_id, ref_code)
-            WHERE ref_code IS NOT NULL
+            CREATE UNIQUE INDEX IF NOT EXISTS uq_appointments_booked_slot
+            ON appointments (clinic_id, date, time)
+            WHERE status = 'Booked'
         """)
+        c.execute("DROP INDEX IF EXISTS idx_appointments_booked_slot")
+        c.execute("RELEASE SAVEPOINT booked_slot_idx")
     except Exception as e:
-        print("Index create uq_appointments_ref_code failed:", repr(e))
+        c.execute("ROLLBACK TO SAVEPOINT booked_slot_idx")
+        print("Index create uq_appointments_booked_slot failed:", repr(e))
+        _create_index_optional(c, "idx_appointments_booked_slot", """
+            CREATE INDEX IF NOT EXISTS idx_appointments_booked_slot
+            ON appointments (clinic_id, date, time)
+            WHERE status = 'Booked'
+        """)
+
+    # "my appointment" / cancel-latest / reschedule: newest booked row per user
+    _create_index_optional(c, "idx_appointments_user_booked", """
+        CREATE INDEX IF NOT EXISTS idx_appointments_user_booked
+        ON appointments (clinic_id, user_number, created_at DESC)
+        WHERE status = 'Booked'
+    """)
+
+    # retry sheets + worker sweep: only the small unsynced tail is indexed
+    _create_index_optional(c, "idx_appointments_unsynced", """
+        CREATE INDEX IF NOT EXISTS idx_appointments_unsynced
+        ON appointments (clinic_id, created_at DESC)
+        WHERE status = 'Booked' AND sheet_sync_status IN ('failed','pending')
+    """)
 
     c.execute("""
         CREATE TABLE IF NOT EXISTS clinic_settings (
@@ -115,278 +268,371 @@ def init_db():
         )
     """)
 
-    try:
-        c.execute("""
-            CREATE INDEX IF NOT EXISTS idx_jobs_status_runat
-            ON jobs(status, run_at)
-        """)
-    except Exception as e:
-        print("Index create idx_jobs_status_runat failed:", repr(e))
+    _create_index_optional(c, "idx_jobs_status_runat", """
+        CREATE INDEX IF NOT EXISTS idx_jobs_status_runat
+        ON jobs(status, run_at)
+    """)
+
+    _create_index_optional(c, "idx_jobs_pending_appointment", """
+        CREATE INDEX IF NOT EXISTS idx_jobs_pending_appointment
+        ON jobs (job_type, (payload->>'appointment_id'))
+        WHERE status IN ('queued','running')
+    """)
 
     conn.commit()
     conn.close()
+    _db_initialized = True
     print("DB tables checked/created successfully")
 
 
 # -------------------------------------------------
 # DB Helpers
 # -------------------------------------------------
-def save_message(clinic_id, user, role, msg, twilio_sid=None):
-    conn = db_conn()
-    c = conn.cursor()
+def _insert_message(c, clinic_id, user, role, msg, twilio_sid=None, created_at=None):
     c.execute(
         """
         INSERT INTO messages (clinic_id, user_number, role, content, created_at, twilio_sid)
         VALUES (%s,%s,%s,%s,%s,%s)
         """,
-        (clinic_id, user, role, msg, datetime.datetime.utcnow(), twilio_sid)
+        (clinic_id, user, role, msg, created_at or datetime.datetime.utcnow(), twilio_sid)
     )
-    conn.commit()
-    conn.close()
 
 
-def save_incoming_message_if_new(clinic_id, user, msg, twilio_sid=None):
-    """
-    Atomic idempotency gate for inbound Twilio webhooks.
+def _clean_draft(draft):
+    # Draft strings are stripped once here, so readers can use them as-is
+    return {k: v.strip() if isinstance(v, str) else v for k, v in (draft or {}).items()}
 
-    Returns:
-        True  -> inbound message was inserted now, safe to continue processing
-        False -> duplicate Twilio SID already exists, stop processing immediately
+
+def _upsert_state_and_draft(c, clinic_id, user, state, draft):
+    c.execute(
+        """
+        INSERT INTO conversations (clinic_id, user_number, context, current_state, draft)
+        VALUES (%s,%s,'',%s,%s)
+        ON CONFLICT (clinic_id, user_number)
+        DO UPDATE SET current_state=EXCLUDED.current_state,
+                      draft=EXCLUDED.draft
+        """,
+        (clinic_id, user, state, psycopg2.extras.Json(_clean_draft(draft)))
+    )
+
+
+def save_message(clinic_id, user, role, msg, twilio_sid=None, created_at=None):
+    with get_conn() as conn, conn.cursor() as c:
+        _insert_message(c, clinic_id, user, role, msg, twilio_sid, created_at)
+
+
+def save_turn(clinic_id, user, reply, state, draft, created_at=None):
     """
-    conn = db_conn()
-    try:
-        c = conn.cursor()
+    Persists the end of a webhook turn (state transition + assistant reply)
+    as one statement: a single round-trip and commit.
+    """
+    with get_conn() as conn, conn.cursor() as c:
         c.execute(
             """
+            WITH state_upsert AS (
+                INSERT INTO conversations (clinic_id, user_number, context, current_state, draft)
+                VALUES (%s,%s,'',%s,%s)
+                ON CONFLICT (clinic_id, user_number)
+                DO UPDATE SET current_state=EXCLUDED.current_state,
+                              draft=EXCLUDED.draft
+            )
             INSERT INTO messages (clinic_id, user_number, role, content, created_at, twilio_sid)
-            VALUES (%s,%s,'user',%s,%s,%s)
+            VALUES (%s,%s,'assistant',%s,%s,NULL)
             """,
-            (clinic_id, user, msg, datetime.datetime.utcnow(), twilio_sid)
+            (
+                clinic_id, user, state, psycopg2.extras.Json(_clean_draft(draft)),
+                clinic_id, user, reply, created_at or datetime.datetime.utcnow(),
+            )
         )
-        conn.commit()
-        return True
-    except IntegrityError as e:
-        conn.rollback()
-        # Duplicate inbound Twilio webhook
-        if twilio_sid:
-            print(f"Duplicate inbound Twilio SID ignored: {twilio_sid} | error={repr(e)}")
-            return False
-        raise
-    finally:
-        conn.close()
 
 
-def already_processed_twilio_sid(twilio_sid: str) -> bool:
-    if not twilio_sid:
-        return False
-    conn = db_conn()
-    c = conn.cursor()
-    c.execute("SELECT 1 FROM messages WHERE twilio_sid=%s LIMIT 1", (twilio_sid,))
-    exists = c.fetchone() is not None
-    conn.close()
-    return exists
+def save_incoming_and_load_state(clinic_id, user, msg, twilio_sid=None, created_at=None):
+    """
+    Idempotency gate + state load in one round trip.
+
+    Returns (is_new, state, draft). is_new is False when the Twilio SID was
+    already stored (duplicate webhook); state/draft are loaded either way.
+    """
+    with get_conn() as conn, conn.cursor() as c:
+        c.execute(
+            """
+            WITH ins AS (
+                INSERT INTO messages (clinic_id, user_number, role, content, created_at, twilio_sid)
+                VALUES (%s,%s,'user',%s,%s,%s)
+                ON CONFLICT DO NOTHING
+                RETURNING id
+            )
+            SELECT EXISTS (SELECT 1 FROM ins), cv.current_state, cv.draft
+            FROM (SELECT 1) AS one
+            LEFT JOIN conversations cv ON cv.clinic_id=%s AND cv.user_number=%s
+            """,
+            (clinic_id, user, msg, created_at or datetime.datetime.utcnow(), twilio_sid, clinic_id, user)
+        )
+        is_new, state, draft = c.fetchone()
+    if not is_new:
+        print(f"Duplicate inbound Twilio SID ignored: {twilio_sid}")
+    state, draft = _state_from_row(state, draft)
+    return is_new, state, draft
 
 
-def load_recent_messages(clinic_id, user, limit=12):
-    conn = db_conn()
-    c = conn.cursor()
-    c.execute(
-        f"SELECT role, content FROM messages WHERE clinic_id=%s AND user_number=%s ORDER BY id DESC LIMIT {limit}",
-        (clinic_id, user)
-    )
-    rows = c.fetchall()
-    conn.close()
-    rows.reverse()
+def load_recent_messages(clinic_id, user, limit=12, after_id=0):
+    with get_conn() as conn, conn.cursor() as c:
+        c.execute(
+            """
+            SELECT role, content FROM (
+                SELECT id, role, content
+                FROM messages
+                WHERE clinic_id=%s AND user_number=%s AND id > %s
+                ORDER BY id DESC
+                LIMIT %s
+            ) recent
+            ORDER BY id ASC
+            """,
+            (clinic_id, user, int(after_id or 0), int(limit))
+        )
+        rows = c.fetchall()
     return [{"role": r, "content": t} for r, t in rows]
 
 
+def load_messages_after(clinic_id, user, after_id=0, limit=24):
+    """
+    Returns [(id, role, content), ...] oldest-first for the newest `limit`
+    messages after after_id (older unsummarized rows are left out).
+    """
+    with get_conn() as conn, conn.cursor() as c:
+        c.execute(
+            """
+            SELECT id, role, content
+            FROM messages
+            WHERE clinic_id=%s AND user_number=%s AND id > %s
+            ORDER BY id DESC
+            LIMIT %s
+            """,
+            (clinic_id, user, int(after_id or 0), int(limit))
+        )
+        rows = c.fetchall()
+    rows.reverse()
+    return rows
+
+
+def load_conversation_summary(clinic_id, user):
+    """
+    Returns (summary, upto_message_id) kept in conversations.context.
+    ("", 0) when no summary has been written yet.
+    """
+    with get_conn() as conn, conn.cursor() as c:
+        c.execute(
+            "SELECT context FROM conversations WHERE clinic_id=%s AND user_number=%s",
+            (clinic_id, user)
+        )
+        row = c.fetchone()
+    if not row or not row[0]:
+        return ("", 0)
+    try:
+        data = json.loads(row[0])
+        return (str(data.get("summary") or ""), int(data.get("upto_id") or 0))
+    except Exception:
+        return ("", 0)
+
+
+def save_conversation_summary(clinic_id, user, summary, upto_id):
+    context = json.dumps({"summary": summary or "", "upto_id": int(upto_id or 0)})
+    with get_conn() as conn, conn.cursor() as c:
+        c.execute(
+            """
+            INSERT INTO conversations (clinic_id, user_number, context)
+            VALUES (%s,%s,%s)
+            ON CONFLICT (clinic_id, user_number)
+            DO UPDATE SET context=EXCLUDED.context
+            """,
+            (clinic_id, user, context)
+        )
+
+
 def update_sheet_sync_status(appointment_id, status, error=None):
+    update_sheet_sync_status_many([appointment_id], status, error)
+
+
+def update_sheet_sync_status_many(appointment_ids, status, error=None):
+    if not appointment_ids:
+        return
     try:
-        conn = db_conn()
-        c = conn.cursor()
-        if status == "synced":
-            c.execute(
-                """
-                UPDATE appointments
-                SET sheet_sync_status=%s,
-                    sheet_sync_error=NULL,
-                    sheet_synced_at=now()
-                WHERE id=%s
-                """,
-                (status, appointment_id)
-            )
-        else:
-            err = (error or "")[:800]
-            c.execute(
-                """
-                UPDATE appointments
-                SET sheet_sync_status=%s,
-                    sheet_sync_error=%s
-                WHERE id=%s
-                """,
-                (status, err, appointment_id)
-            )
-        conn.commit()
-        conn.close()
+        with get_conn() as conn, conn.cursor() as c:
+            if status == "synced":
+                c.execute(
+                    """
+                    UPDATE appointments
+                    SET sheet_sync_status=%s,
+                        sheet_sync_error=NULL,
+                        sheet_synced_at=now()
+                    WHERE id = ANY(%s)
+                    """,
+                    (status, list(appointment_ids))
+                )
+            else:
+                err = (error or "")[:800]
+                c.execute(
+                    """
+                    UPDATE appointments
+                    SET sheet_sync_status=%s,
+                        sheet_sync_error=%s
+                    WHERE id = ANY(%s)
+                    """,
+                    (status, err, list(appointment_ids))
+                )
     except Exception as e:
         print("update_sheet_sync_status FAILED:", repr(e))
 
 
 def get_unsynced_appointments(clinic_id, limit=20):
-    conn = db_conn()
-    c = conn.cursor()
-    c.execute(
-        """
-        SELECT id, user_number, name, date, time, sheet_sync_status
-        FROM appointments
-        WHERE clinic_id=%s
-          AND status='Booked'
-          AND sheet_sync_status IN ('failed','pending')
-        ORDER BY created_at DESC
-        LIMIT %s
-        """,
-        (clinic_id, limit)
-    )
-    rows = c.fetchall()
-    conn.close()
-    return rows
+    with get_conn() as conn, conn.cursor() as c:
+        c.execute(
+            """
+            SELECT id, user_number, name, date, time, sheet_sync_status
+            FROM appointments
+            WHERE clinic_id=%s
+              AND status='Booked'
+              AND sheet_sync_status IN ('failed','pending')
+            ORDER BY created_at DESC
+            LIMIT %s
+            """,
+            (clinic_id, limit)
+        )
+        return c.fetchall()
+
+
+def get_appointment_status(appointment_id):
+    with get_conn() as conn, conn.cursor() as c:
+        c.execute("SELECT status FROM appointments WHERE id=%s", (appointment_id,))
+        row = c.fetchone()
+    return row[0] if row else None
 
 
 def cancel_latest_appointment(clinic_id, user):
-    conn = db_conn()
-    c = conn.cursor()
-    c.execute(
-        """
-        SELECT id, name, date, time, ref_code
-        FROM appointments
-        WHERE clinic_id=%s AND user_number=%s AND status='Booked'
-        ORDER BY created_at DESC
-        LIMIT 1
-        """,
-        (clinic_id, user)
-    )
-    row = c.fetchone()
-    if not row:
-        conn.close()
-        return None
+    with get_conn() as conn, conn.cursor() as c:
+        c.execute(
+            """
+            SELECT id, name, date, time, ref_code
+            FROM appointments
+            WHERE clinic_id=%s AND user_number=%s AND status='Booked'
+            ORDER BY created_at DESC
+            LIMIT 1
+            """,
+            (clinic_id, user)
+        )
+        row = c.fetchone()
+        if not row:
+            return None
 
-    appt_id, name, date, time, ref_code = row
-    c.execute(
-        """
-        UPDATE appointments
-        SET status='Cancelled', cancelled_at=now()
-        WHERE id=%s
-        """,
-        (appt_id,)
-    )
-    conn.commit()
-    conn.close()
+        appt_id, name, date, time, ref_code = row
+        c.execute(
+            """
+            UPDATE appointments
+            SET status='Cancelled', cancelled_at=now()
+            WHERE id=%s
+            """,
+            (appt_id,)
+        )
     return {"id": appt_id, "name": name, "date": date, "time": time, "ref_code": ref_code}
 
 
 def cancel_by_ref(clinic_id, user, ref_code):
-    conn = db_conn()
-    c = conn.cursor()
-    c.execute(
-        """
-        SELECT id, name, date, time, user_number
-        FROM appointments
-        WHERE clinic_id=%s AND ref_code=%s AND status='Booked'
-        LIMIT 1
-        """,
-        (clinic_id, ref_code)
-    )
-    row = c.fetchone()
-    if not row:
-        conn.close()
-        return None
+    with get_conn() as conn, conn.cursor() as c:
+        c.execute(
+            """
+            SELECT id, name, date, time, user_number
+            FROM appointments
+            WHERE clinic_id=%s AND ref_code=%s AND status='Booked'
+            LIMIT 1
+            """,
+            (clinic_id, ref_code)
+        )
+        row = c.fetchone()
+        if not row:
+            return None
 
-    appt_id, name, date, time, booked_user = row
+        appt_id, name, date, time, booked_user = row
 
-    if (booked_user or "") != (user or ""):
-        conn.close()
-        return "not_owner"
+        if (booked_user or "") != (user or ""):
+            return "not_owner"
 
-    c.execute(
-        """
-        UPDATE appointments
-        SET status='Cancelled', cancelled_at=now()
-        WHERE id=%s
-        """,
-        (appt_id,)
-    )
-    conn.commit()
-    conn.close()
+        c.execute(
+            """
+            UPDATE appointments
+            SET status='Cancelled', cancelled_at=now()
+            WHERE id=%s
+            """,
+            (appt_id,)
+        )
     return {"id": appt_id, "name": name, "date": date, "time": time}
 
 
 def get_latest_booked_appointment(clinic_id, user):
-    conn = db_conn()
-    c = conn.cursor()
-    c.execute(
-        """
-        SELECT id, name, date, time, created_at, ref_code
-        FROM appointments
-        WHERE clinic_id=%s AND user_number=%s AND status='Booked'
-        ORDER BY created_at DESC
-        LIMIT 1
-        """,
-        (clinic_id, user)
-    )
-    row = c.fetchone()
-    conn.close()
-    return row
+    with get_conn() as conn, conn.cursor() as c:
+        c.execute(
+            """
+            SELECT id, name, date, time, created_at, ref_code
+            FROM appointments
+            WHERE clinic_id=%s AND user_number=%s AND status='Booked'
+            ORDER BY created_at DESC
+            LIMIT 1
+            """,
+            (clinic_id, user)
+        )
+        return c.fetchone()
 
 
-def get_todays_appointments(clinic_id, date_str):
-    conn = db_conn()
-    c = conn.cursor()
-    c.execute(
-        """
-        SELECT name, user_number, time, sheet_sync_status, ref_code
-        FROM appointments
-        WHERE clinic_id=%s AND date=%s AND status='Booked'
-        ORDER BY time ASC
-        """,
-        (clinic_id, date_str)
-    )
-    rows = c.fetchall()
-    conn.close()
-    return rows
+def get_todays_appointments(clinic_id, date_str, limit=None):
+    # LIMIT NULL means no limit in Postgres
+    with get_conn() as conn, conn.cursor() as c:
+        c.execute(
+            """
+            SELECT name, user_number, time, sheet_sync_status, ref_code
+            FROM appointments
+            WHERE clinic_id=%s AND date=%s AND status='Booked'
+            ORDER BY time ASC
+            LIMIT %s
+            """,
+            (clinic_id, date_str, limit)
+        )
+        return c.fetchall()
+
+
+def _parse_settings_value(value):
+    if value is None:
+        return {}
+    if isinstance(value, str):
+        try:
+            return json.loads(value)
+        except:
+            return {}
+    return value if isinstance(value, dict) else {}
 
 
 def load_clinic_settings(clinic_id):
     try:
-        conn = db_conn()
-        c = conn.cursor()
-        c.execute("SELECT settings FROM clinic_settings WHERE clinic_id=%s", (clinic_id,))
-        row = c.fetchone()
-        conn.close()
-        if not row or row[0] is None:
-            return {}
-        if isinstance(row[0], str):
-            try:
-                return json.loads(row[0])
-            except:
-                return {}
-        return row[0] if isinstance(row[0], dict) else {}
+        with get_conn() as conn, conn.cursor() as c:
+            c.execute("SELECT settings FROM clinic_settings WHERE clinic_id=%s", (clinic_id,))
+            row = c.fetchone()
+        return _parse_settings_value(row[0] if row else None)
     except Exception as e:
         print("load_clinic_settings FAILED:", repr(e))
         return {}
 
 
 def get_state_and_draft(clinic_id, user):
-    conn = db_conn()
-    c = conn.cursor()
-    c.execute(
-        "SELECT current_state, draft FROM conversations WHERE clinic_id=%s AND user_number=%s",
-        (clinic_id, user)
-    )
-    row = c.fetchone()
-    conn.close()
+    with get_conn() as conn, conn.cursor() as c:
+        c.execute(
+            "SELECT current_state, draft FROM conversations WHERE clinic_id=%s AND user_number=%s",
+            (clinic_id, user)
+        )
+        row = c.fetchone()
     if not row:
         return ("idle", {})
-    state, draft = row[0], row[1]
+    return _state_from_row(row[0], row[1])
+
+
+def _state_from_row(state, draft):
     if draft is None:
         draft = {}
     if isinstance(draft, str):
@@ -398,20 +644,8 @@ def get_state_and_draft(clinic_id, user):
 
 
 def set_state_and_draft(clinic_id, user, state, draft):
-    conn = db_conn()
-    c = conn.cursor()
-    c.execute(
-        """
-        INSERT INTO conversations (clinic_id, user_number, context, current_state, draft)
-        VALUES (%s,%s,'',%s,%s)
-        ON CONFLICT (clinic_id, user_number)
-        DO UPDATE SET current_state=EXCLUDED.current_state,
-                      draft=EXCLUDED.draft
-        """,
-        (clinic_id, user, state, psycopg2.extras.Json(draft or {}))
-    )
-    conn.commit()
-    conn.close()
+    with get_conn() as conn, conn.cursor() as c:
+        _upsert_state_and_draft(c, clinic_id, user, state, draft)
 
 
 def clear_state_machine(clinic_id, user):
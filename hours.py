@@ -1,5 +1,6 @@
 import datetime
 import re
+from functools import lru_cache
 from zoneinfo import ZoneInfo
 
 DEFAULT_HOURS = {
@@ -33,9 +34,11 @@ def get_hours_settings(clinic_settings: dict):
         weekly = DEFAULT_HOURS["weekly"]
     return timezone, slot_minutes, weekly
 
+_HHMM_RE = re.compile(r"^(\d{1,2}):(\d{2})$")
+
 def parse_hhmm_to_minutes(hhmm: str):
     hhmm = (hhmm or "").strip()
-    m = re.match(r"^(\d{1,2}):(\d{2})$", hhmm)
+    m = _HHMM_RE.match(hhmm)
     if not m:
         return None
     h = int(m.group(1))
@@ -44,25 +47,48 @@ def parse_hhmm_to_minutes(hhmm: str):
         return None
     return h * 60 + mi
 
+# "14:00", "9:30", "2:30 PM", "2:30pm" -> parsed straight from the groups, no strptime.
+# Minutes must be two digits: "9:5" (which strptime took as 09:05) is rejected.
+_TIME_RE = re.compile(r"^(\d{1,2}):(\d{2})(?:\s*([ap])m)?$", re.IGNORECASE)
+
 def normalize_time_to_24h(s: str):
-    s = (s or "").strip()
-    try:
-        t = datetime.datetime.strptime(s, "%H:%M").time()
-        return f"{t.hour:02d}:{t.minute:02d}"
-    except:
-        pass
-    try:
-        t = datetime.datetime.strptime(s, "%I:%M %p").time()
-        return f"{t.hour:02d}:{t.minute:02d}"
-    except:
+    m = _TIME_RE.match((s or "").strip())
+    if not m:
+        return None
+    h = int(m.group(1))
+    mi = int(m.group(2))
+    ampm = m.group(3)
+    if mi > 59:
         return None
+    if ampm:
+        if not 1 <= h <= 12:
+            return None
+        h = h % 12 + (12 if ampm.lower() == "p" else 0)
+    elif h > 23:
+        return None
+    return f"{h:02d}:{mi:02d}"
+
+@lru_cache(maxsize=32)
+def get_tz(tz_name: str):
+    # Raises like ZoneInfo() for unknown names; failures aren't cached
+    return ZoneInfo(tz_name)
+
+_WEEKDAY_KEYS = ("mon", "tue", "wed", "thu", "fri", "sat", "sun")
+
+# Same inputs strptime("%Y-%m-%d") accepted, including unpadded month/day
+_YMD_RE = re.compile(r"^(\d{4})-(\d{1,2})-(\d{1,2})$")
+
+def parse_ymd(date_str: str) -> datetime.date:
+    m = _YMD_RE.match(date_str or "")
+    if not m:
+        raise ValueError(f"not a YYYY-MM-DD date: {date_str!r}")
+    return datetime.date(int(m.group(1)), int(m.group(2)), int(m.group(3)))
 
 def weekday_key_from_date(date_str: str, tz_name: str):
-    tz = ZoneInfo(tz_name)
-    d = datetime.datetime.strptime(date_str, "%Y-%m-%d").date()
-    idx = datetime.datetime(d.year, d.month, d.day, 12, 0, tzinfo=tz).weekday()
-    keys = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
-    return keys[idx]
+    get_tz(tz_name)  # still rejects an invalid timezone name
+    d = parse_ymd(date_str)
+    # A calendar date's weekday doesn't depend on the zone
+    return _WEEKDAY_KEYS[d.weekday()]
 
 def is_open_on_date(date_str: str, tz_name: str, weekly: dict):
     try:
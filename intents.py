@@ -1,4 +1,6 @@
-import datetime
+import re
+
+from hours import parse_ymd
 
 # -------------------------------------------------
 # Booking intent keywords
@@ -16,6 +18,13 @@ BOOKING_KEYWORDS = [
     "visit clinic"
 ]
 
+# One compiled alternation so a message is scanned once, not once per keyword.
+# Leading \b only: "notebook" no longer counts, "booked"/"appointments" still do.
+_BOOKING_RE = re.compile(
+    r"\b(?:" + "|".join(re.escape(k) for k in BOOKING_KEYWORDS) + ")",
+    re.IGNORECASE
+)
+
 # -------------------------------------------------
 # Cancel / Reschedule intent keywords (separate)
 # -------------------------------------------------
@@ -39,6 +48,10 @@ RESCHEDULE_KEYWORDS = [
     "change date"
 ]
 
+# Same substring semantics as the old any(k in t ...) loops, one scan each
+_CANCEL_RE = re.compile("|".join(re.escape(k) for k in CANCEL_KEYWORDS), re.IGNORECASE)
+_RESCHEDULE_RE = re.compile("|".join(re.escape(k) for k in RESCHEDULE_KEYWORDS), re.IGNORECASE)
+
 
 def is_booking_intent(text):
     """
@@ -48,8 +61,7 @@ def is_booking_intent(text):
     if not text:
         return False
 
-    t = text.lower().strip()
-    return any(k in t for k in BOOKING_KEYWORDS)
+    return _BOOKING_RE.search(text) is not None
 
 
 def is_cancel_intent(text):
@@ -59,8 +71,7 @@ def is_cancel_intent(text):
     if not text:
         return False
 
-    t = text.lower().strip()
-    return any(k in t for k in CANCEL_KEYWORDS)
+    return _CANCEL_RE.search(text) is not None
 
 
 def is_reschedule_intent(text):
@@ -70,8 +81,7 @@ def is_reschedule_intent(text):
     if not text:
         return False
 
-    t = text.lower().strip()
-    return any(k in t for k in RESCHEDULE_KEYWORDS)
+    return _RESCHEDULE_RE.search(text) is not None
 
 
 def looks_like_date(s):
@@ -80,7 +90,7 @@ def looks_like_date(s):
     Kept to avoid breaking existing logic.
     """
     try:
-        datetime.datetime.strptime(s.strip(), "%Y-%m-%d")
+        parse_ymd((s or "").strip())
         return True
-    except:
+    except ValueError:
         return False
@@ -2,79 +2,87 @@ import os
 import datetime
 import psycopg2.extras
 
-from db import db_conn
+from db import get_conn
 
 WORKER_NAME = os.getenv("WORKER_NAME", "worker-1")
 
 
 def enqueue_job(job_type: str, payload: dict, run_at=None, max_attempts=8):
     run_at = run_at or datetime.datetime.utcnow()
-    conn = db_conn()
-    c = conn.cursor()
-    c.execute(
-        """
-        INSERT INTO jobs (job_type, payload, status, run_at, max_attempts)
-        VALUES (%s, %s, 'queued', %s, %s)
-        RETURNING id
-        """,
-        (job_type, psycopg2.extras.Json(payload or {}), run_at, int(max_attempts))
-    )
-    job_id = c.fetchone()[0]
-    conn.commit()
-    conn.close()
+    with get_conn() as conn, conn.cursor() as c:
+        c.execute(
+            """
+            INSERT INTO jobs (job_type, payload, status, run_at, max_attempts)
+            VALUES (%s, %s, 'queued', %s, %s)
+            RETURNING id
+            """,
+            (job_type, psycopg2.extras.Json(payload or {}), run_at, int(max_attempts))
+        )
+        job_id = c.fetchone()[0]
     return job_id
 
 
+def enqueue_jobs(job_type: str, payloads, run_at=None, max_attempts=8) -> int:
+    """
+    Bulk enqueue: one INSERT round trip for all payloads.
+    """
+    if not payloads:
+        return 0
+    run_at = run_at or datetime.datetime.utcnow()
+    rows = [(job_type, psycopg2.extras.Json(p or {}), "queued", run_at, int(max_attempts)) for p in payloads]
+    with get_conn() as conn, conn.cursor() as c:
+        psycopg2.extras.execute_values(
+            c,
+            "INSERT INTO jobs (job_type, payload, status, run_at, max_attempts) VALUES %s",
+            rows
+        )
+    return len(rows)
+
+
 def fetch_and_lock_jobs(limit=5):
     """
     Atomically claim jobs using SKIP LOCKED.
     """
-    conn = db_conn()
-    c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-    c.execute(
-        """
-        WITH picked AS (
-          SELECT id
-          FROM jobs
-          WHERE status='queued'
-            AND run_at <= now()
-          ORDER BY run_at ASC, id ASC
-          FOR UPDATE SKIP LOCKED
-          LIMIT %s
+    with get_conn() as conn, conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as c:
+        c.execute(
+            """
+            WITH picked AS (
+              SELECT id
+              FROM jobs
+              WHERE status='queued'
+                AND run_at <= now()
+              ORDER BY run_at ASC, id ASC
+              FOR UPDATE SKIP LOCKED
+              LIMIT %s
+            )
+            UPDATE jobs j
+            SET status='running',
+                locked_at=now(),
+                locked_by=%s,
+                updated_at=now()
+            FROM picked
+            WHERE j.id = picked.id
+            RETURNING j.*
+            """,
+            (limit, WORKER_NAME)
         )
-        UPDATE jobs j
-        SET status='running',
-            locked_at=now(),
-            locked_by=%s,
-            updated_at=now()
-        FROM picked
-        WHERE j.id = picked.id
-        RETURNING j.*
-        """,
-        (limit, WORKER_NAME)
-    )
-    rows = c.fetchall()
-    conn.commit()
-    conn.close()
+        rows = c.fetchall()
     return rows
 
 
 def mark_done(job_id: int):
-    conn = db_conn()
-    c = conn.cursor()
-    c.execute(
-        """
-        UPDATE jobs
-        SET status='done',
-            locked_at=NULL,
-            locked_by=NULL,
-            updated_at=now()
-        WHERE id=%s
-        """,
-        (job_id,)
-    )
-    conn.commit()
-    conn.close()
+    with get_conn() as conn, conn.cursor() as c:
+        c.execute(
+            """
+            UPDATE jobs
+            SET status='done',
+                locked_at=NULL,
+                locked_by=NULL,
+                updated_at=now()
+            WHERE id=%s
+            """,
+            (job_id,)
+        )
 
 
 def reschedule_or_fail(job_id: int, attempts: int, max_attempts: int, error: str):
@@ -86,107 +94,121 @@ def reschedule_or_fail(job_id: int, attempts: int, max_attempts: int, error: str
     err = (error or "")[:1200]
 
     if attempts >= max_attempts:
-        conn = db_conn()
-        c = conn.cursor()
+        with get_conn() as conn, conn.cursor() as c:
+            c.execute(
+                """
+                UPDATE jobs
+                SET status='failed',
+                    attempts=%s,
+                    last_error=%s,
+                    updated_at=now()
+                WHERE id=%s
+                """,
+                (attempts, err, job_id)
+            )
+        return
+
+    delay = 30 * (2 ** (attempts - 1))
+    run_at = datetime.datetime.utcnow() + datetime.timedelta(seconds=delay)
+
+    with get_conn() as conn, conn.cursor() as c:
         c.execute(
             """
             UPDATE jobs
-            SET status='failed',
+            SET status='queued',
                 attempts=%s,
                 last_error=%s,
+                run_at=%s,
+                locked_at=NULL,
+                locked_by=NULL,
                 updated_at=now()
             WHERE id=%s
             """,
-            (attempts, err, job_id)
+            (attempts, err, run_at, job_id)
         )
-        conn.commit()
-        conn.close()
-        return
-
-    delay = 30 * (2 ** (attempts - 1))
-    run_at = datetime.datetime.utcnow() + datetime.timedelta(seconds=delay)
-
-    conn = db_conn()
-    c = conn.cursor()
-    c.execute(
-        """
-        UPDATE jobs
-        SET status='queued',
-            attempts=%s,
-            last_error=%s,
-            run_at=%s,
-            locked_at=NULL,
-            locked_by=NULL,
-            updated_at=now()
-        WHERE id=%s
-        """,
-        (attempts, err, run_at, job_id)
-    )
-    conn.commit()
-    conn.close()
 
 
 def has_pending_sync_job(appointment_id: int) -> bool:
     """
     Returns True if there's already a queued/running sync_sheet job for this appointment_id.
     """
-    conn = db_conn()
-    c = conn.cursor()
-    c.execute(
-        """
-        SELECT 1
-        FROM jobs
-        WHERE job_type='sync_sheet'
-          AND status IN ('queued','running')
-          AND (payload->>'appointment_id')::text = %s
-        LIMIT 1
-        """,
-        (str(appointment_id),)
-    )
-    exists = c.fetchone() is not None
-    conn.close()
+    with get_conn() as conn, conn.cursor() as c:
+        c.execute(
+            """
+            SELECT 1
+            FROM jobs
+            WHERE job_type='sync_sheet'
+              AND status IN ('queued','running')
+              AND (payload->>'appointment_id')::text = %s
+            LIMIT 1
+            """,
+            (str(appointment_id),)
+        )
+        exists = c.fetchone() is not None
     return exists
 
 
 # ✅ NEW: generic pending-job check for appointment-based jobs (reminders, etc.)
 def has_pending_job_for_appointment(job_type: str, appointment_id: int) -> bool:
-    conn = db_conn()
-    c = conn.cursor()
-    c.execute(
-        """
-        SELECT 1
-        FROM jobs
-        WHERE job_type=%s
-          AND status IN ('queued','running')
-          AND (payload->>'appointment_id')::text = %s
-        LIMIT 1
-        """,
-        (job_type, str(appointment_id))
-    )
-    exists = c.fetchone() is not None
-    conn.close()
+    with get_conn() as conn, conn.cursor() as c:
+        c.execute(
+            """
+            SELECT 1
+            FROM jobs
+            WHERE job_type=%s
+              AND status IN ('queued','running')
+              AND (payload->>'appointment_id')::text = %s
+            LIMIT 1
+            """,
+            (job_type, str(appointment_id))
+        )
+        exists = c.fetchone() is not None
     return exists
 
 
 # ✅ NEW: cancel queued/running jobs tied to an appointment (e.g., reminders)
 def cancel_jobs_for_appointment(job_type: str, appointment_id: int):
-    conn = db_conn()
-    c = conn.cursor()
-    c.execute(
-        """
-        UPDATE jobs
-        SET status='cancelled',
-            locked_at=NULL,
-            locked_by=NULL,
-            updated_at=now()
-        WHERE job_type=%s
-          AND status IN ('queued','running')
-          AND (payload->>'appointment_id')::text = %s
-        """,
-        (job_type, str(appointment_id))
-    )
-    conn.commit()
-    conn.close()
+    with get_conn() as conn, conn.cursor() as c:
+        c.execute(
+            """
+            UPDATE jobs
+            SET status='cancelled',
+                locked_at=NULL,
+                locked_by=NULL,
+                updated_at=now()
+            WHERE job_type=%s
+              AND status IN ('queued','running')
+              AND (payload->>'appointment_id')::text = %s
+            """,
+            (job_type, str(appointment_id))
+        )
+
+
+def has_pending_job_for_user(job_type: str, clinic_id, user: str, failed_within_minutes=None) -> bool:
+    """
+    True when a queued/running job of this type exists for the user. With
+    failed_within_minutes, a job that failed within that window also counts,
+    so callers back off instead of re-enqueueing the same failing work.
+    """
+    with get_conn() as conn, conn.cursor() as c:
+        c.execute(
+            """
+            SELECT 1
+            FROM jobs
+            WHERE job_type=%s
+              AND payload->>'clinic_id' = %s
+              AND payload->>'user' = %s
+              AND (
+                  status IN ('queued','running')
+                  OR (%s IS NOT NULL AND status='failed'
+                      AND updated_at > now() - make_interval(mins => %s))
+              )
+            LIMIT 1
+            """,
+            (job_type, str(clinic_id), str(user), failed_within_minutes, int(failed_within_minutes or 0))
+        )
+        exists = c.fetchone() is not None
+    return exists
 
 
 # ============================================================
@@ -200,28 +222,26 @@ def get_job_counts(job_type=None):
     Returns counts grouped by status.
     If job_type is provided, filters to that job_type.
     """
-    conn = db_conn()
-    c = conn.cursor()
-    if job_type:
-        c.execute(
-            """
-            SELECT status, COUNT(*)
-            FROM jobs
-            WHERE job_type=%s
-            GROUP BY status
-            """,
-            (job_type,)
-        )
-    else:
-        c.execute(
-            """
-            SELECT status, COUNT(*)
-            FROM jobs
-            GROUP BY status
-            """
-        )
-    rows = c.fetchall()
-    conn.close()
+    with get_conn() as conn, conn.cursor() as c:
+        if job_type:
+            c.execute(
+                """
+                SELECT status, COUNT(*)
+                FROM jobs
+                WHERE job_type=%s
+                GROUP BY status
+                """,
+                (job_type,)
+            )
+        else:
+            c.execute(
+                """
+                SELECT status, COUNT(*)
+                FROM jobs
+                GROUP BY status
+                """
+            )
+        rows = c.fetchall()
     return {status: count for status, count in rows}
 
 
@@ -229,36 +249,32 @@ def count_stale_running_jobs(minutes=5, job_type=None):
     """
     Counts running jobs whose locked_at is older than N minutes.
     """
-    conn = db_conn()
-    c = conn.cursor()
-    interval = f"{int(minutes)} minutes"
-
-    if job_type:
-        c.execute(
-            """
-            SELECT COUNT(*)
-            FROM jobs
-            WHERE status='running'
-              AND job_type=%s
-              AND locked_at IS NOT NULL
-              AND locked_at < now() - (%s)::interval
-            """,
-            (job_type, interval)
-        )
-    else:
-        c.execute(
-            """
-            SELECT COUNT(*)
-            FROM jobs
-            WHERE status='running'
-              AND locked_at IS NOT NULL
-              AND locked_at < now() - (%s)::interval
-            """,
-            (interval,)
-        )
+    with get_conn() as conn, conn.cursor() as c:
+        if job_type:
+            c.execute(
+                """
+                SELECT COUNT(*)
+                FROM jobs
+                WHERE status='running'
+                  AND job_type=%s
+                  AND locked_at IS NOT NULL
+                  AND locked_at < now() - make_interval(mins => %s)
+                """,
+                (job_type, int(minutes))
+            )
+        else:
+            c.execute(
+                """
+                SELECT COUNT(*)
+                FROM jobs
+                WHERE status='running'
+                  AND locked_at IS NOT NULL
+                  AND locked_at < now() - make_interval(mins => %s)
+                """,
+                (int(minutes),)
+            )
 
-    count = c.fetchone()[0]
-    conn.close()
+        count = c.fetchone()[0]
     return count
 
 
@@ -266,33 +282,30 @@ def list_failed_jobs(job_type=None, limit=10):
     """
     Returns latest failed jobs (optionally filtered by job_type).
     """
-    conn = db_conn()
-    c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-
-    if job_type:
-        c.execute(
-            """
-            SELECT *
-            FROM jobs
-            WHERE status='failed'
-              AND job_type=%s
-            ORDER BY updated_at DESC, id DESC
-            LIMIT %s
-            """,
-            (job_type, int(limit))
-        )
-    else:
-        c.execute(
-            """
-            SELECT *
-            FROM jobs
-            WHERE status='failed'
-            ORDER BY updated_at DESC, id DESC
-            LIMIT %s
-            """,
-            (int(limit),)
-        )
+    with get_conn() as conn, conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as c:
+        if job_type:
+            c.execute(
+                """
+                SELECT *
+                FROM jobs
+                WHERE status='failed'
+                  AND job_type=%s
+                ORDER BY updated_at DESC, id DESC
+                LIMIT %s
+                """,
+                (job_type, int(limit))
+            )
+        else:
+            c.execute(
+                """
+                SELECT *
+                FROM jobs
+                WHERE status='failed'
+                ORDER BY updated_at DESC, id DESC
+                LIMIT %s
+                """,
+                (int(limit),)
+            )
 
-    rows = c.fetchall()
-    conn.close()
+        rows = c.fetchall()
     return rows
@@ -1,27 +1,29 @@
 import datetime
 import json
+import logging
 import re
 import traceback
-from zoneinfo import ZoneInfo
+from types import SimpleNamespace
+from xml.sax.saxutils import escape as xml_escape
 
-from flask import request, Response
+from flask import request, Response, g
 from twilio.twiml.messaging_response import MessagingResponse
 
 from admin import is_admin
 from ai import ai_reply, ai_extract_booking_signal, OFFER_BOOKING_MARKER
-from booking import check_double_booking, save_appointment_local
-from clinic import resolve_clinic_id, get_clinic_sheet_config, validate_clinic_settings
+from booking import check_double_booking, save_appointment_local, SlotTakenError
+from clinic import resolve_clinic, get_clinic_sheet_config, validate_clinic_settings, clear_clinic_cache
 from db import (
-    save_message, save_incoming_message_if_new,
-    load_clinic_settings,
+    save_message, save_incoming_and_load_state, save_turn,
     get_todays_appointments, get_unsynced_appointments,
-    update_sheet_sync_status,
+    update_sheet_sync_status_many,
     cancel_by_ref, cancel_latest_appointment,
     get_latest_booked_appointment,
     clear_state_machine, get_state_and_draft, set_state_and_draft,
 )
 from hours import (
     get_hours_settings,
+    get_tz,
     normalize_time_to_24h,
     is_open_on_date,
     is_time_within_hours,
@@ -29,15 +31,40 @@ from hours import (
     format_opening_hours_for_day,
 )
 from intents import is_booking_intent, looks_like_date, is_cancel_intent, is_reschedule_intent
-from sheets import append_to_sheet, append_ref_to_latest_row, update_sheet_status_by_ref
+from sheets import append_rows_to_sheet, clear_header_cache
 from jobs import get_job_counts, count_stale_running_jobs, list_failed_jobs
 from jobs import enqueue_job, cancel_jobs_for_appointment
 
 
 REMINDER_MINUTES_BEFORE = 120  # 2 hours before appointment
+TODAY_LIST_LIMIT = 30  # rows shown by the admin "today" command
+
+_CANCEL_REF_RE = re.compile(r"^CANCEL\s+(AP-[A-Z0-9]{6})$")
+_BLANK_LINES_RE = re.compile(r"\n{3,}")
+
+_IDLE_STATES = frozenset({None, "", "idle"})
+
+# Exact replies accepted at the confirm step
+_YES = frozenset({"yes", "y", "yeah", "yep"})
+_NO = frozenset({"no", "n", "nope"})
+
+
+logger = logging.getLogger("routes")
+
+# Per-turn trace lines; logged at DEBUG so they cost nothing at the default level
+_DEBUG_TAGS = frozenset({
+    "CLINIC_RESOLVED",
+    "STATE_LOADED",
+    "AI_EXTRACTED",
+    "AI_REPLY_RAW",
+    "DOUBLE_BOOKING_CHECK",
+})
 
 
 def log_event(tag, **kwargs):
+    level = logging.DEBUG if tag in _DEBUG_TAGS else logging.INFO
+    if not logger.isEnabledFor(level):
+        return
     try:
         parts = [f"[{tag}]"]
         for k, v in kwargs.items():
@@ -53,19 +80,100 @@ def log_event(tag, **kwargs):
                 v = v[:300] + "..."
 
             parts.append(f"{k}={v}")
-        print(" | ".join(parts))
+        logger.log(level, " | ".join(parts))
     except Exception as e:
-        print(f"[LOG_EVENT_FAILED] tag={tag} error={repr(e)}")
+        logger.warning("[LOG_EVENT_FAILED] tag=%s error=%r", tag, e)
+
+
+def _twiml_bytes(reply: str) -> bytes:
+    r = MessagingResponse()
+    r.message().body(reply)
+    return str(r).encode("utf-8")
+
+
+_FATAL_REPLY = "Sorry, something went wrong on our side. Please try again in a moment."
+
+# Serialized once at import; fixed prompts skip the TwiML builder per request
+_FIXED_REPLIES = (
+    "Sure. What's your full name?",
+    "Great — what’s your full name?",
+    "What date would you like? (YYYY-MM-DD)",
+    "Please confirm the date in this format: YYYY-MM-DD (example: 2026-01-30).",
+    "Sorry, we’re closed on that day. Please choose another date.",
+    "Please type the time like 09:30 (HH:MM) or 2:30 PM.",
+    "That slot is already booked. Choose another time.",
+    "Please reply with 'yes' to confirm or 'no' to cancel.",
+    "No problem — booking cancelled. Type 'book' to start again.",
+    "No problem. Would you like me to help you book an appointment? (yes/no)",
+    "Session reset. You can start again.",
+    _FATAL_REPLY,
+)
+_FIXED_TWIML = {reply: _twiml_bytes(reply) for reply in _FIXED_REPLIES}
+
+
+def _empty_twiml_bytes() -> bytes:
+    r = MessagingResponse()
+    r.message()
+    return str(r).encode("utf-8")
+
+
+# Ack for duplicate webhooks: an empty <Message/>, same bytes as before
+_EMPTY_TWIML = _empty_twiml_bytes()
 
+# Dynamic replies whose only variable parts are date/time/ref: the serialized
+# skeleton is filled in one regex pass. Values are escaped the same way
+# ElementTree escapes text, since an AI-extracted date isn't format-checked.
+_CONFIRM_PROMPT_TMPL = "Confirm appointment on {date} at {time}? (yes/no)"
+_BOOKED_TMPL = "✅ Appointment confirmed for {date} at {time}\nRef: {ref}\nTo cancel: cancel {ref}"
+_CONFIRM_PROMPT_TWIML = _twiml_bytes(_CONFIRM_PROMPT_TMPL)
+_BOOKED_TWIML = _twiml_bytes(_BOOKED_TMPL)
 
-def _reply_and_return(resp, msg, clinic_id, user, reply, action=None, **extra):
-    msg.body(reply)
+
+_TWIML_FIELD_RE = re.compile(rb"\{(date|time|ref)\}")
+
+
+def _fill_twiml(tmpl: bytes, **values) -> bytes:
+    # Single pass over the original template: a value that itself contains
+    # "{ref}" etc. is never substituted again
+    filled = {k.encode("ascii"): xml_escape(str(v)).encode("utf-8") for k, v in values.items()}
+    return _TWIML_FIELD_RE.sub(lambda m: filled.get(m.group(1), m.group(0)), tmpl)
+
+
+def _defer(fn, *args, **kwargs):
+    """
+    Queues work that doesn't shape the reply; it runs after the TwiML has been
+    sent (Response.call_on_close), on the same worker thread and in order.
+    """
+    g.setdefault("deferred", []).append((fn, args, kwargs))
+
+
+def _run_deferred(tasks):
+    for fn, args, kwargs in tasks:
+        try:
+            fn(*args, **kwargs)
+        except Exception as e:
+            log_event("DEFERRED_TASK_FAILED", task=getattr(fn, "__name__", repr(fn)), error=repr(e))
+
+
+def _save_assistant_message(clinic_id, user, reply, created_at):
     try:
-        if clinic_id:
-            save_message(clinic_id, user, "assistant", reply)
+        save_message(clinic_id, user, "assistant", reply, created_at=created_at)
     except Exception as e:
         log_event("SAVE_ASSISTANT_MESSAGE_FAILED", clinic_id=clinic_id, user=user, error=repr(e))
 
+
+def _reply_and_return(resp, msg, clinic_id, user, reply, action=None, next_state=None, next_draft=None, twiml=None, **extra):
+    body = twiml if twiml is not None else _FIXED_TWIML.get(reply)
+    if body is None:
+        msg.body(reply)
+    if clinic_id and next_state is not None:
+        # State transition + assistant message are written in one transaction.
+        # A failed state write must still surface as an error, like before.
+        save_turn(clinic_id, user, reply, next_state, next_draft, created_at=g.get("request_now"))
+    elif clinic_id:
+        # Plain transcript write; the next turn only needs it seconds from now
+        _defer(_save_assistant_message, clinic_id, user, reply, g.get("request_now"))
+
     log_event(
         "REPLY",
         clinic_id=clinic_id,
@@ -74,13 +182,21 @@ def _reply_and_return(resp, msg, clinic_id, user, reply, action=None, **extra):
         reply=reply,
         **extra
     )
-    return Response(str(resp), mimetype="application/xml")
+    if body is not None:
+        response = Response(body, mimetype="application/xml", direct_passthrough=True)
+    else:
+        response = Response(str(resp), mimetype="application/xml")
+
+    tasks = g.pop("deferred", None)
+    if tasks:
+        response.call_on_close(lambda: _run_deferred(tasks))
+    return response
 
 
 def _normalize_phone_for_lookup(raw: str) -> str:
     s = (raw or "").strip()
     s = s.replace("whatsapp:", "").strip()
-    s = re.sub(r"\s+", "", s)
+    s = _MULTI_SPACE_RE.sub("", s)
     return s
 
 
@@ -92,30 +208,74 @@ def _extract_state_target(incoming: str, fallback_user: str) -> str:
     return candidate or fallback_user
 
 
+_NON_ALNUM_RE = re.compile(r"[^a-z0-9\s]")
+_MULTI_SPACE_RE = re.compile(r"\s+")
+
+
+def _norm_text(text: str) -> str:
+    t = _NON_ALNUM_RE.sub(" ", (text or "").lower().strip())
+    return _MULTI_SPACE_RE.sub(" ", t).strip()
+
+
+def _keyword_matcher(keywords):
+    """
+    Normalizes keywords once: single words go in a frozenset checked against the
+    message tokens, multi-word phrases are compiled into one whole-word regex so
+    the message is scanned once however many phrases there are.
+    """
+    normed = {_norm_text(k) for k in keywords}
+    words = frozenset(k for k in normed if " " not in k)
+    phrases = sorted((k for k in normed if " " in k), key=len, reverse=True)
+    phrase_re = re.compile(r"(?<!\S)(?:" + "|".join(map(re.escape, phrases)) + r")(?!\S)") if phrases else None
+    return words, phrase_re
+
+
+def _has_keyword(t_norm: str, matcher) -> bool:
+    words, phrase_re = matcher
+    if not words.isdisjoint(t_norm.split()):
+        return True
+    return phrase_re is not None and phrase_re.search(t_norm) is not None
+
+
+_GREETING_PHRASES = frozenset({
+    "good morning", "good afternoon", "good evening", "good day",
+    "morning", "afternoon", "evening",
+    "habari", "niaje", "sasa", "mambo",
+    "goodmorning", "goodafternoon", "goodevening"
+})
+_GREETING_WORDS = frozenset({"hi", "hello", "hey", "yo"})
+
+_AGREE_MATCHER = _keyword_matcher([
+    "yes", "yess", "yeah", "yep", "sure", "okay", "ok", "alright", "proceed", "go ahead",
+    "please", "kindly", "sounds good", "that works", "i would", "i want", "i need",
+    "help me", "can you", "could you",
+    # booking-ish
+    "book", "booked", "booking", "appointment", "appointments", "schedule", "reschedule",
+    "visit", "come in",
+    "see dentist", "see the dentist", "consultation", "checkup", "check-up"
+])
+
+_DECLINE_MATCHER = _keyword_matcher([
+    "no", "nope", "not now", "later", "maybe later", "another time",
+    "not today", "no thanks", "dont", "do not", "just asking"
+])
+
+
 def _is_greeting(text: str) -> bool:
     if not text:
         return False
 
-    t = text.lower().strip()
-    t_norm = re.sub(r"[^a-z0-9\s]", " ", t)
-    t_norm = re.sub(r"\s+", " ", t_norm).strip()
+    t_norm = _norm_text(text)
 
     if len(t_norm) > 30:
         return False
 
-    phrases = {
-        "good morning", "good afternoon", "good evening", "good day",
-        "morning", "afternoon", "evening",
-        "habari", "niaje", "sasa", "mambo",
-        "goodmorning", "goodafternoon", "goodevening"
-    }
-    if t_norm in phrases:
+    if t_norm in _GREETING_PHRASES:
         return True
 
     words = set(t_norm.split())
-    single_words = {"hi", "hello", "hey", "yo"}
 
-    if len(words) <= 3 and not any(ch.isdigit() for ch in t_norm) and (words & single_words):
+    if len(words) <= 3 and not any(ch.isdigit() for ch in t_norm) and (words & _GREETING_WORDS):
         return True
 
     return False
@@ -124,38 +284,13 @@ def _is_greeting(text: str) -> bool:
 def _looks_like_booking_agree(text: str) -> bool:
     if not text:
         return False
-
-    t = text.lower().strip()
-    t_norm = re.sub(r"[^a-z0-9\s]", " ", t)
-    t_norm = re.sub(r"\s+", " ", t_norm).strip()
-
-    positive = [
-        "yes", "yeah", "yep", "sure", "okay", "ok", "alright", "proceed", "go ahead",
-        "please", "kindly", "sounds good", "that works", "i would", "i want", "i need",
-        "help me", "can you", "could you"
-    ]
-
-    bookingish = [
-        "book", "booking", "appointment", "schedule", "reschedule", "visit", "come in",
-        "see dentist", "see the dentist", "consultation", "checkup", "check-up"
-    ]
-
-    return any(p in t_norm for p in positive) or any(b in t_norm for b in bookingish)
+    return _has_keyword(_norm_text(text), _AGREE_MATCHER)
 
 
 def _looks_like_booking_decline(text: str) -> bool:
     if not text:
         return False
-
-    t = text.lower().strip()
-    t_norm = re.sub(r"[^a-z0-9\s]", " ", t)
-    t_norm = re.sub(r"\s+", " ", t_norm).strip()
-
-    decline = [
-        "no", "nope", "not now", "later", "maybe later", "another time",
-        "not today", "no thanks", "dont", "do not", "just asking"
-    ]
-    return any(d in t_norm for d in decline)
+    return _has_keyword(_norm_text(text), _DECLINE_MATCHER)
 
 
 def _safe_admin_numbers(clinic_settings: dict):
@@ -174,6 +309,45 @@ def _safe_admin_numbers(clinic_settings: dict):
     return out
 
 
+def _enqueue_sheet_sync(clinic_id, twilio_sid, appt_id, ref_code, date, time_24, name, user, sheet_id, sheet_tab):
+    """
+    Hands the Sheets append + REF write to the worker. If the enqueue itself
+    fails the row stays 'pending' and the worker's sweep picks it up.
+    """
+    try:
+        enqueue_job("sync_sheet", {
+            "appointment_id": appt_id,
+            "ref_code": ref_code,
+            "date": date,
+            "time": time_24,
+            "name": name,
+            "phone": user,
+            "sheet_id": sheet_id,
+            "sheet_tab": sheet_tab
+        })
+    except Exception as e:
+        log_event("SHEETS_SYNC_ENQUEUE_FAILED", clinic_id=clinic_id, sid=twilio_sid, appointment_id=appt_id, error=repr(e))
+
+
+def _enqueue_sheet_status_update(appt_id, ref_code, status, sheet_id, sheet_tab, clinic_id=None, sid=None, fail_tag="SHEETS_STATUS_UPDATE_FAILED"):
+    """
+    Hands a Sheets STATUS write (cancel/reschedule) to the worker. The job waits
+    for any pending sync_sheet of the same appointment and is retried until the
+    row exists, so it can't be lost to an append that hasn't happened yet.
+    """
+    try:
+        enqueue_job("sheet_status", {
+            "appointment_id": appt_id,
+            "ref_code": ref_code,
+            "status": status,
+            "sheet_id": sheet_id,
+            "sheet_tab": sheet_tab
+        })
+        log_event("SHEETS_STATUS_UPDATE_ENQUEUED", clinic_id=clinic_id, sid=sid, appointment_id=appt_id, ref_code=ref_code, status=status)
+    except Exception as e:
+        log_event(fail_tag, clinic_id=clinic_id, sid=sid, appointment_id=appt_id, ref_code=ref_code, error=repr(e))
+
+
 def _enqueue_admin_notify(clinic_id, clinic_settings: dict, body: str, appointment_id=None):
     admins = _safe_admin_numbers(clinic_settings)
     if not admins:
@@ -209,16 +383,17 @@ def _schedule_patient_reminder(
     date: str,
     time_24h: str,
     ref_code: str = None,
-    tz_name: str = "Africa/Nairobi"
+    tz_name: str = "Africa/Nairobi",
+    now_utc=None
 ):
     try:
-        tz = ZoneInfo(tz_name or "Africa/Nairobi")
+        tz = get_tz(tz_name or "Africa/Nairobi")
         dt = datetime.datetime.strptime(f"{date} {time_24h}", "%Y-%m-%d %H:%M")
         appt_local = dt.replace(tzinfo=tz)
         run_at_local = appt_local - datetime.timedelta(minutes=REMINDER_MINUTES_BEFORE)
         run_at_utc = run_at_local.astimezone(datetime.timezone.utc).replace(tzinfo=None)
 
-        if run_at_utc <= datetime.datetime.utcnow():
+        if run_at_utc <= (now_utc or datetime.datetime.utcnow()):
             log_event(
                 "REMINDER_SKIPPED",
                 clinic_id=clinic_id,
@@ -271,6 +446,156 @@ def _schedule_patient_reminder(
         )
 
 
+def _handle_await_cancel_ref(t):
+    if t.incoming_lc == "cancel":
+        clear_state_machine(t.clinic_id, t.user)
+        cancelled = cancel_latest_appointment(t.clinic_id, t.user)
+        log_event("AWAIT_CANCEL_REF_CANCEL", clinic_id=t.clinic_id, sid=t.sid, cancelled=cancelled)
+
+        if not cancelled:
+            return _reply_and_return(t.resp, t.msg, t.clinic_id, t.user, "I couldn’t find an active booked appointment to cancel.", action="await_cancel_ref_not_found", sid=t.sid)
+
+        try:
+            cancel_jobs_for_appointment("patient_reminder", cancelled["id"])
+        except Exception as e:
+            log_event("CANCEL_REMINDER_JOBS_FAILED", clinic_id=t.clinic_id, sid=t.sid, appointment_id=cancelled["id"], error=repr(e))
+
+        _defer(
+            _enqueue_sheet_status_update,
+            cancelled["id"], cancelled.get("ref_code"), "Cancelled", t.sheet_id, t.sheet_tab,
+            clinic_id=t.clinic_id, sid=t.sid, fail_tag="SHEETS_CANCEL_AWAIT_FAILED"
+        )
+
+        reply = f"✅ Cancelled your appointment on {cancelled['date']} at {cancelled['time']}. Ref: {cancelled['ref_code']}"
+        return _reply_and_return(t.resp, t.msg, t.clinic_id, t.user, reply, action="await_cancel_ref_success", sid=t.sid)
+
+    reply = "Please reply with your reference like: cancel AP-XXXXXX — or reply: cancel (to cancel your latest appointment)."
+    return _reply_and_return(t.resp, t.msg, t.clinic_id, t.user, reply, action="await_cancel_ref_prompt", sid=t.sid)
+
+
+def _handle_collect_name(t):
+    t.draft["name"] = t.incoming.strip()
+    return _reply_and_return(t.resp, t.msg, t.clinic_id, t.user, "What date would you like? (YYYY-MM-DD)", action="name_collected", sid=t.sid, draft=t.draft, next_state="collect_date", next_draft=t.draft)
+
+
+def _handle_collect_date(t):
+    if looks_like_date(t.incoming):
+        date_str = t.incoming.strip()
+
+        if not is_open_on_date(date_str, t.tz_name, t.weekly):
+            return _reply_and_return(t.resp, t.msg, t.clinic_id, t.user, "Sorry, we’re closed on that day. Please choose another date.", action="collect_date_closed", sid=t.sid, date=date_str)
+
+        t.draft["date"] = date_str
+        reply = f"What time would you prefer? (HH:MM) e.g. 14:00. Slots are {t.slot_minutes} minutes."
+        return _reply_and_return(t.resp, t.msg, t.clinic_id, t.user, reply, action="date_collected", sid=t.sid, draft=t.draft, next_state="collect_time", next_draft=t.draft)
+
+    reply = "Please confirm the date in this format: YYYY-MM-DD (example: 2026-01-30)."
+    return _reply_and_return(t.resp, t.msg, t.clinic_id, t.user, reply, action="collect_date_invalid", sid=t.sid)
+
+
+def _handle_collect_time(t):
+    time_24 = normalize_time_to_24h(t.incoming)
+    if not time_24:
+        return _reply_and_return(t.resp, t.msg, t.clinic_id, t.user, "Please type the time like 09:30 (HH:MM) or 2:30 PM.", action="collect_time_invalid", sid=t.sid)
+
+    date = t.draft.get("date", "")
+
+    if not is_time_within_hours(date, time_24, t.tz_name, t.weekly):
+        hours_str = format_opening_hours_for_day(date, t.tz_name, t.weekly)
+        reply = f"That time is outside working hours for {date}. Available: {hours_str}."
+        return _reply_and_return(t.resp, t.msg, t.clinic_id, t.user, reply, action="collect_time_outside_hours", sid=t.sid, date=date, time=time_24)
+
+    if not is_slot_aligned(time_24, t.slot_minutes):
+        reply = f"Please choose a time that matches our {t.slot_minutes}-minute slots (e.g. 09:00, 09:30, 10:00)."
+        return _reply_and_return(t.resp, t.msg, t.clinic_id, t.user, reply, action="collect_time_not_aligned", sid=t.sid, time=time_24)
+
+    is_taken = check_double_booking(t.clinic_id, date, time_24, t.sheet_id, t.sheet_tab)
+    log_event("DOUBLE_BOOKING_CHECK", clinic_id=t.clinic_id, sid=t.sid, date=date, time=time_24, taken=is_taken)
+
+    if is_taken:
+        return _reply_and_return(t.resp, t.msg, t.clinic_id, t.user, "That slot is already booked. Choose another time.", action="collect_time_slot_taken", sid=t.sid, date=date, time=time_24)
+
+    t.draft["time"] = time_24
+    reply = _CONFIRM_PROMPT_TMPL.format(date=date, time=time_24)
+    twiml = _fill_twiml(_CONFIRM_PROMPT_TWIML, date=date, time=time_24)
+    return _reply_and_return(t.resp, t.msg, t.clinic_id, t.user, reply, action="collect_time_confirm", sid=t.sid, draft=t.draft, next_state="confirm", next_draft=t.draft, twiml=twiml)
+
+
+def _handle_confirm(t):
+    if t.incoming_lc in _YES:
+        draft_get = t.draft.get
+        name, date, time_24 = draft_get("name", ""), draft_get("date", ""), draft_get("time", "")
+
+        log_event("BOOKING_CONFIRM_START", clinic_id=t.clinic_id, sid=t.sid, name=name, date=date, time=time_24)
+
+        try:
+            appt_id, ref_code = save_appointment_local(
+                t.clinic_id,
+                t.user,
+                name,
+                date,
+                time_24,
+                source_message_sid=t.sid,
+                created_at=t.now_utc
+            )
+        except SlotTakenError:
+            # Someone else confirmed the same slot between our check and this insert
+            t.draft.pop("time", None)
+            return _reply_and_return(t.resp, t.msg, t.clinic_id, t.user, "That slot is already booked. Choose another time.", action="confirm_slot_taken", sid=t.sid, date=date, time=time_24, next_state="collect_time", next_draft=t.draft)
+        log_event("BOOKING_SAVED_DB", clinic_id=t.clinic_id, sid=t.sid, appointment_id=appt_id, ref_code=ref_code)
+
+        _defer(
+            _enqueue_sheet_sync,
+            t.clinic_id, t.sid, appt_id, ref_code,
+            date, time_24, name, t.user,
+            t.sheet_id, t.sheet_tab
+        )
+
+        clear_state_machine(t.clinic_id, t.user)
+
+        reply = _BOOKED_TMPL.format(date=date, time=time_24, ref=ref_code)
+
+        _defer(
+            _enqueue_admin_notify,
+            t.clinic_id,
+            t.clinic_settings,
+            f"✅ Appointment BOOKED\nDate: {date}\nTime: {time_24}\nName: {name}\nPatient: {t.user}\nRef: {ref_code}",
+            appointment_id=appt_id
+        )
+
+        _defer(
+            _schedule_patient_reminder,
+            clinic_id=t.clinic_id,
+            user_number=t.user,
+            clinic_settings=t.clinic_settings,
+            appointment_id=appt_id,
+            patient_name=name,
+            date=date,
+            time_24h=time_24,
+            ref_code=ref_code,
+            tz_name=t.tz_name,
+            now_utc=t.now_utc
+        )
+
+        twiml = _fill_twiml(_BOOKED_TWIML, date=date, time=time_24, ref=ref_code)
+        return _reply_and_return(t.resp, t.msg, t.clinic_id, t.user, reply, action="booking_confirmed", sid=t.sid, appointment_id=appt_id, ref_code=ref_code, twiml=twiml)
+
+    if t.incoming_lc in _NO:
+        return _reply_and_return(t.resp, t.msg, t.clinic_id, t.user, "No problem — booking cancelled. Type 'book' to start again.", action="booking_cancelled_at_confirm", sid=t.sid, next_state="idle", next_draft={})
+
+    return _reply_and_return(t.resp, t.msg, t.clinic_id, t.user, "Please reply with 'yes' to confirm or 'no' to cancel.", action="confirm_reprompt", sid=t.sid)
+
+
+# Mid-flow states: each handler always produces the reply for this turn
+_STATE_HANDLERS = {
+    "await_cancel_ref": _handle_await_cancel_ref,
+    "collect_name": _handle_collect_name,
+    "collect_date": _handle_collect_date,
+    "collect_time": _handle_collect_time,
+    "confirm": _handle_confirm,
+}
+
+
 def register_routes(app):
 
     @app.get("/")
@@ -282,8 +607,14 @@ def register_routes(app):
         resp = MessagingResponse()
         msg = resp.message()
 
+        # One clock read per request, shared by every row written in this turn.
+        # Stored naive (UTC) to match the timestamp-without-time-zone columns.
+        now_utc = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        g.request_now = now_utc
+
         try:
             incoming = request.values.get("Body", "").strip()
+            incoming_lc = incoming.lower()  # commands and yes/no checks compare against this
             raw_from = request.values.get("From", "")
             user = raw_from.replace("whatsapp:", "")
             to_number = request.values.get("To", "").strip()
@@ -298,7 +629,8 @@ def register_routes(app):
                 incoming=incoming
             )
 
-            clinic_id = resolve_clinic_id(to_number)
+            # Channel lookup + clinic settings in a single query
+            clinic_id, clinic_settings = resolve_clinic(to_number)
             log_event("CLINIC_RESOLVED", sid=twilio_sid, to_number=to_number, clinic_id=clinic_id)
 
             if not clinic_id:
@@ -310,7 +642,6 @@ def register_routes(app):
                     to_number=to_number
                 )
 
-            clinic_settings = load_clinic_settings(clinic_id)
             clinic_settings, config_errors, config_warnings = validate_clinic_settings(clinic_settings)
 
             if config_warnings:
@@ -346,20 +677,22 @@ def register_routes(app):
                 sheet_tab=clinic_sheet_tab
             )
 
-            is_new_inbound = save_incoming_message_if_new(
+            # Inbound insert (deduped on Twilio SID) and conversation state in one query
+            is_new_inbound, state, draft = save_incoming_and_load_state(
                 clinic_id=clinic_id,
                 user=user,
                 msg=incoming,
-                twilio_sid=twilio_sid
+                twilio_sid=twilio_sid,
+                created_at=now_utc
             )
             if not is_new_inbound:
                 log_event("DUPLICATE_WEBHOOK_IGNORED", sid=twilio_sid, clinic_id=clinic_id, user=user)
-                return Response(str(resp), mimetype="application/xml")
+                return Response(_EMPTY_TWIML, mimetype="application/xml", direct_passthrough=True)
 
             # -------------------------------------------------
             # Admin debug commands
             # -------------------------------------------------
-            if incoming.strip().lower().startswith("state"):
+            if incoming_lc.startswith("state"):
                 if not is_admin(user, clinic_settings):
                     return _reply_and_return(
                         resp, msg, clinic_id, user,
@@ -396,7 +729,7 @@ def register_routes(app):
                     target_user=target_user
                 )
 
-            if incoming.strip().lower() == "clinic check":
+            if incoming_lc == "clinic check":
                 if not is_admin(user, clinic_settings):
                     return _reply_and_return(
                         resp, msg, clinic_id, user,
@@ -446,24 +779,24 @@ def register_routes(app):
                     sid=twilio_sid
                 )
 
-            if incoming.strip().lower() == "today":
+            if incoming_lc == "today":
                 if not is_admin(user, clinic_settings):
                     return _reply_and_return(resp, msg, clinic_id, user, "Not authorized.", action="today_unauthorized", sid=twilio_sid)
 
-                today = datetime.datetime.now(ZoneInfo(tz_name)).strftime("%Y-%m-%d")
-                rows = get_todays_appointments(clinic_id, today)
+                today = now_utc.replace(tzinfo=datetime.timezone.utc).astimezone(get_tz(tz_name)).strftime("%Y-%m-%d")
+                rows = get_todays_appointments(clinic_id, today, limit=TODAY_LIST_LIMIT)
                 log_event("TODAY_COMMAND", clinic_id=clinic_id, sid=twilio_sid, rows_count=len(rows), today=today)
 
                 if not rows:
                     reply = f"No booked appointments for today ({today})."
                 else:
-                    lines = [f"Today ({today}) appointments:"]
-                    for (name, phone, time, sync_status, ref_code) in rows[:30]:
-                        lines.append(f"- {time} | {name} | {phone} | ref:{ref_code} | sheets:{sync_status}")
-                    reply = "\n".join(lines)
+                    reply = f"Today ({today}) appointments:\n" + "\n".join(
+                        f"- {time} | {name} | {phone} | ref:{ref_code} | sheets:{sync_status}"
+                        for (name, phone, time, sync_status, ref_code) in rows
+                    )
                 return _reply_and_return(resp, msg, clinic_id, user, reply, action="today_success", sid=twilio_sid)
 
-            if incoming.strip().lower() == "retry sheets":
+            if incoming_lc == "retry sheets":
                 if not is_admin(user, clinic_settings):
                     return _reply_and_return(resp, msg, clinic_id, user, "Not authorized.", action="retry_sheets_unauthorized", sid=twilio_sid)
 
@@ -473,22 +806,34 @@ def register_routes(app):
                 if not rows:
                     return _reply_and_return(resp, msg, clinic_id, user, "No pending/failed sheet syncs found.", action="retry_sheets_none", sid=twilio_sid)
 
-                attempted = synced = failed = 0
-                for (appt_id, appt_user, appt_name, appt_date, appt_time, appt_status) in rows:
-                    attempted += 1
-                    ok = append_to_sheet(appt_date, appt_time, appt_name, appt_user, clinic_sheet_id, clinic_sheet_tab)
-                    if ok:
-                        synced += 1
-                        update_sheet_sync_status(appt_id, "synced")
-                    else:
-                        failed += 1
-                        update_sheet_sync_status(appt_id, "failed", "Retry sheets failed (see logs)")
+                # One values.append for every pending row, one UPDATE for the outcome
+                appt_ids = [r[0] for r in rows]
+                ok = append_rows_to_sheet(
+                    [(appt_date, appt_time, appt_name, appt_user) for (_, appt_user, appt_name, appt_date, appt_time, _) in rows],
+                    clinic_sheet_id, clinic_sheet_tab
+                )
+                if ok:
+                    update_sheet_sync_status_many(appt_ids, "synced")
+                else:
+                    update_sheet_sync_status_many(appt_ids, "failed", "Retry sheets failed (see logs)")
+                attempted = len(rows)
+                synced = attempted if ok else 0
+                failed = attempted - synced
 
                 reply = f"Retry complete ✅\nAttempted: {attempted}\nSynced: {synced}\nFailed: {failed}"
                 log_event("RETRY_SHEETS_DONE", clinic_id=clinic_id, sid=twilio_sid, attempted=attempted, synced=synced, failed=failed)
                 return _reply_and_return(resp, msg, clinic_id, user, reply, action="retry_sheets_done", sid=twilio_sid)
 
-            if incoming.strip().lower() == "jobs":
+            if incoming_lc == "reset headers":
+                if not is_admin(user, clinic_settings):
+                    return _reply_and_return(resp, msg, clinic_id, user, "Not authorized.", action="reset_headers_unauthorized", sid=twilio_sid)
+
+                dropped = clear_header_cache(clinic_sheet_id, clinic_sheet_tab) if clinic_sheet_id else clear_header_cache()
+                clear_clinic_cache()
+                log_event("RESET_HEADERS_COMMAND", clinic_id=clinic_id, sid=twilio_sid, dropped=dropped)
+                return _reply_and_return(resp, msg, clinic_id, user, "Sheet header + clinic settings cache cleared ✅ They will be re-read on the next message.", action="reset_headers_done", sid=twilio_sid)
+
+            if incoming_lc == "jobs":
                 if not is_admin(user, clinic_settings):
                     return _reply_and_return(resp, msg, clinic_id, user, "Not authorized.", action="jobs_unauthorized", sid=twilio_sid)
 
@@ -509,7 +854,7 @@ def register_routes(app):
                 log_event("JOBS_COMMAND", clinic_id=clinic_id, sid=twilio_sid, all_counts=all_counts, sheet_counts=sheet_counts, stale_all=stale_all, stale_sheet=stale_sheet)
                 return _reply_and_return(resp, msg, clinic_id, user, reply, action="jobs_success", sid=twilio_sid)
 
-            if incoming.strip().lower() in ["failed jobs", "jobs failed"]:
+            if incoming_lc in ["failed jobs", "jobs failed"]:
                 if not is_admin(user, clinic_settings):
                     return _reply_and_return(resp, msg, clinic_id, user, "Not authorized.", action="failed_jobs_unauthorized", sid=twilio_sid)
 
@@ -531,7 +876,7 @@ def register_routes(app):
 
                 return _reply_and_return(resp, msg, clinic_id, user, reply, action="failed_jobs_success", sid=twilio_sid)
 
-            if incoming.strip().lower() == "my appointment":
+            if incoming_lc == "my appointment":
                 appt = get_latest_booked_appointment(clinic_id, user)
                 log_event("MY_APPOINTMENT_COMMAND", clinic_id=clinic_id, sid=twilio_sid, found=bool(appt))
 
@@ -542,7 +887,7 @@ def register_routes(app):
                     reply = f"Your next appointment is on {date} at {time_} under the name {name}. Ref: {ref_code}"
                 return _reply_and_return(resp, msg, clinic_id, user, reply, action="my_appointment", sid=twilio_sid)
 
-            m = re.match(r"^cancel\s+(AP-[A-Z0-9]{6})$", incoming.strip().upper())
+            m = _CANCEL_REF_RE.match(incoming.upper())
             if m:
                 ref_code = m.group(1)
                 result = cancel_by_ref(clinic_id, user, ref_code)
@@ -554,11 +899,11 @@ def register_routes(app):
                 if not result:
                     return _reply_and_return(resp, msg, clinic_id, user, "I couldn’t find an active booked appointment with that reference.", action="cancel_ref_not_found", sid=twilio_sid)
 
-                try:
-                    update_sheet_status_by_ref(ref_code, "Cancelled", clinic_sheet_id, clinic_sheet_tab)
-                    log_event("SHEETS_CANCEL_BY_REF_OK", clinic_id=clinic_id, sid=twilio_sid, ref_code=ref_code)
-                except Exception as e:
-                    log_event("SHEETS_CANCEL_BY_REF_FAILED", clinic_id=clinic_id, sid=twilio_sid, ref_code=ref_code, error=repr(e))
+                _defer(
+                    _enqueue_sheet_status_update,
+                    result["id"], ref_code, "Cancelled", clinic_sheet_id, clinic_sheet_tab,
+                    clinic_id=clinic_id, sid=twilio_sid, fail_tag="SHEETS_CANCEL_BY_REF_FAILED"
+                )
 
                 reply = f"✅ Cancelled appointment on {result['date']} at {result['time']}."
 
@@ -571,7 +916,7 @@ def register_routes(app):
 
                 return _reply_and_return(resp, msg, clinic_id, user, reply, action="cancel_ref_success", sid=twilio_sid, ref_code=ref_code)
 
-            if incoming.strip().lower() == "cancel":
+            if incoming_lc == "cancel":
                 clear_state_machine(clinic_id, user)
                 cancelled = cancel_latest_appointment(clinic_id, user)
                 log_event("CANCEL_LATEST", clinic_id=clinic_id, sid=twilio_sid, cancelled=cancelled)
@@ -585,11 +930,11 @@ def register_routes(app):
                 except Exception as e:
                     log_event("CANCEL_REMINDER_JOBS_FAILED", clinic_id=clinic_id, sid=twilio_sid, appointment_id=cancelled["id"], error=repr(e))
 
-                try:
-                    update_sheet_status_by_ref(cancelled.get("ref_code"), "Cancelled", clinic_sheet_id, clinic_sheet_tab)
-                    log_event("SHEETS_CANCEL_LATEST_OK", clinic_id=clinic_id, sid=twilio_sid, ref_code=cancelled.get("ref_code"))
-                except Exception as e:
-                    log_event("SHEETS_CANCEL_LATEST_FAILED", clinic_id=clinic_id, sid=twilio_sid, ref_code=cancelled.get("ref_code"), error=repr(e))
+                _defer(
+                    _enqueue_sheet_status_update,
+                    cancelled["id"], cancelled.get("ref_code"), "Cancelled", clinic_sheet_id, clinic_sheet_tab,
+                    clinic_id=clinic_id, sid=twilio_sid, fail_tag="SHEETS_CANCEL_LATEST_FAILED"
+                )
 
                 reply = f"✅ Cancelled your appointment on {cancelled['date']} at {cancelled['time']}. Ref: {cancelled['ref_code']}"
 
@@ -602,7 +947,7 @@ def register_routes(app):
 
                 return _reply_and_return(resp, msg, clinic_id, user, reply, action="cancel_latest_success", sid=twilio_sid)
 
-            if incoming.strip().lower() == "reschedule":
+            if incoming_lc == "reschedule":
                 clear_state_machine(clinic_id, user)
                 cancelled = cancel_latest_appointment(clinic_id, user)
                 set_state_and_draft(clinic_id, user, "collect_name", {})
@@ -615,11 +960,11 @@ def register_routes(app):
                     except Exception as e:
                         log_event("CANCEL_REMINDER_JOBS_FAILED", clinic_id=clinic_id, sid=twilio_sid, appointment_id=cancelled["id"], error=repr(e))
 
-                    try:
-                        update_sheet_status_by_ref(cancelled.get("ref_code"), "Rescheduled", clinic_sheet_id, clinic_sheet_tab)
-                        log_event("SHEETS_RESCHEDULE_OK", clinic_id=clinic_id, sid=twilio_sid, ref_code=cancelled.get("ref_code"))
-                    except Exception as e:
-                        log_event("SHEETS_RESCHEDULE_FAILED", clinic_id=clinic_id, sid=twilio_sid, ref_code=cancelled.get("ref_code"), error=repr(e))
+                    _defer(
+                        _enqueue_sheet_status_update,
+                        cancelled["id"], cancelled.get("ref_code"), "Rescheduled", clinic_sheet_id, clinic_sheet_tab,
+                        clinic_id=clinic_id, sid=twilio_sid, fail_tag="SHEETS_RESCHEDULE_FAILED"
+                    )
 
                     reply = f"✅ Cancelled {cancelled['date']} {cancelled['time']} (Ref: {cancelled['ref_code']}).\nLet’s reschedule. What’s your full name?"
 
@@ -641,19 +986,31 @@ def register_routes(app):
 
                 return _reply_and_return(resp, msg, clinic_id, user, reply, action="reschedule_start", sid=twilio_sid)
 
-            if incoming.strip().lower() == "reset":
-                clear_state_machine(clinic_id, user)
+            if incoming_lc == "reset":
                 log_event("RESET_COMMAND", clinic_id=clinic_id, sid=twilio_sid, user=user)
-                return _reply_and_return(resp, msg, clinic_id, user, "Session reset. You can start again.", action="reset", sid=twilio_sid)
+                return _reply_and_return(resp, msg, clinic_id, user, "Session reset. You can start again.", action="reset", sid=twilio_sid, next_state="idle", next_draft={})
 
-            state, draft = get_state_and_draft(clinic_id, user)
             log_event("STATE_LOADED", clinic_id=clinic_id, sid=twilio_sid, state=state, draft=draft)
 
-            extracted = ai_extract_booking_signal(clinic, incoming)
+            handler = _STATE_HANDLERS.get(state)
+            if handler:
+                return handler(SimpleNamespace(
+                    resp=resp, msg=msg, clinic_id=clinic_id, user=user, sid=twilio_sid,
+                    incoming=incoming, incoming_lc=incoming_lc,
+                    draft=draft, clinic_settings=clinic_settings,
+                    tz_name=tz_name, weekly=weekly, slot_minutes=slot_minutes,
+                    sheet_id=clinic_sheet_id, sheet_tab=clinic_sheet_tab, now_utc=now_utc
+                ))
+
+            # Extraction only feeds the idle-state branches; mid-flow replies skip the OpenAI call
+            if state in _IDLE_STATES:
+                extracted = ai_extract_booking_signal(clinic, incoming)
+                log_event("AI_EXTRACTED", clinic_id=clinic_id, sid=twilio_sid, extracted=extracted)
+            else:
+                extracted = {"intent": "general", "name": None, "date": None, "time": None}
             extracted_intent = extracted.get("intent", "general")
-            log_event("AI_EXTRACTED", clinic_id=clinic_id, sid=twilio_sid, extracted=extracted)
 
-            if state in [None, "", "idle"] and (extracted_intent in ["cancel", "reschedule"] or is_cancel_intent(incoming) or is_reschedule_intent(incoming)):
+            if state in _IDLE_STATES and (extracted_intent in ["cancel", "reschedule"] or is_cancel_intent(incoming) or is_reschedule_intent(incoming)):
                 if extracted_intent == "reschedule" or is_reschedule_intent(incoming):
                     clear_state_machine(clinic_id, user)
                     cancelled = cancel_latest_appointment(clinic_id, user)
@@ -666,10 +1023,11 @@ def register_routes(app):
                         except Exception as e:
                             log_event("CANCEL_REMINDER_JOBS_FAILED", clinic_id=clinic_id, sid=twilio_sid, appointment_id=cancelled["id"], error=repr(e))
 
-                        try:
-                            update_sheet_status_by_ref(cancelled.get("ref_code"), "Rescheduled", clinic_sheet_id, clinic_sheet_tab)
-                        except Exception as e:
-                            log_event("SHEETS_RESCHEDULE_FAILED", clinic_id=clinic_id, sid=twilio_sid, ref_code=cancelled.get("ref_code"), error=repr(e))
+                        _defer(
+                            _enqueue_sheet_status_update,
+                            cancelled["id"], cancelled.get("ref_code"), "Rescheduled", clinic_sheet_id, clinic_sheet_tab,
+                            clinic_id=clinic_id, sid=twilio_sid, fail_tag="SHEETS_RESCHEDULE_FAILED"
+                        )
 
                         reply = f"✅ Cancelled {cancelled['date']} {cancelled['time']} (Ref: {cancelled['ref_code']}).\nLet’s reschedule. What’s your full name?"
                     else:
@@ -677,48 +1035,21 @@ def register_routes(app):
 
                     return _reply_and_return(resp, msg, clinic_id, user, reply, action="idle_reschedule_intent", sid=twilio_sid)
 
-                set_state_and_draft(clinic_id, user, "await_cancel_ref", {})
                 reply = (
                     "Sure — I can cancel it.\n"
                     "If you have your reference code, reply like: cancel AP-XXXXXX\n"
                     "If you don’t have it, reply: cancel"
                 )
-                return _reply_and_return(resp, msg, clinic_id, user, reply, action="await_cancel_ref", sid=twilio_sid)
-
-            if state == "await_cancel_ref":
-                if incoming.strip().lower() == "cancel":
-                    clear_state_machine(clinic_id, user)
-                    cancelled = cancel_latest_appointment(clinic_id, user)
-                    log_event("AWAIT_CANCEL_REF_CANCEL", clinic_id=clinic_id, sid=twilio_sid, cancelled=cancelled)
-
-                    if not cancelled:
-                        return _reply_and_return(resp, msg, clinic_id, user, "I couldn’t find an active booked appointment to cancel.", action="await_cancel_ref_not_found", sid=twilio_sid)
+                return _reply_and_return(resp, msg, clinic_id, user, reply, action="await_cancel_ref", sid=twilio_sid, next_state="await_cancel_ref", next_draft={})
 
-                    try:
-                        cancel_jobs_for_appointment("patient_reminder", cancelled["id"])
-                    except Exception as e:
-                        log_event("CANCEL_REMINDER_JOBS_FAILED", clinic_id=clinic_id, sid=twilio_sid, appointment_id=cancelled["id"], error=repr(e))
-
-                    try:
-                        update_sheet_status_by_ref(cancelled.get("ref_code"), "Cancelled", clinic_sheet_id, clinic_sheet_tab)
-                    except Exception as e:
-                        log_event("SHEETS_CANCEL_AWAIT_FAILED", clinic_id=clinic_id, sid=twilio_sid, ref_code=cancelled.get("ref_code"), error=repr(e))
-
-                    reply = f"✅ Cancelled your appointment on {cancelled['date']} at {cancelled['time']}. Ref: {cancelled['ref_code']}"
-                    return _reply_and_return(resp, msg, clinic_id, user, reply, action="await_cancel_ref_success", sid=twilio_sid)
-
-                reply = "Please reply with your reference like: cancel AP-XXXXXX — or reply: cancel (to cancel your latest appointment)."
-                return _reply_and_return(resp, msg, clinic_id, user, reply, action="await_cancel_ref_prompt", sid=twilio_sid)
-
-            if state in [None, "", "idle"] and (extracted_intent == "greeting" or _is_greeting(incoming)):
+            if state in _IDLE_STATES and (extracted_intent == "greeting" or _is_greeting(incoming)):
                 clinic_name = clinic_settings.get("name", "PrimeCare Dental Clinic")
                 reply = f"Hello 👋 Welcome to {clinic_name}. How may we help you today?"
                 return _reply_and_return(resp, msg, clinic_id, user, reply, action="greeting", sid=twilio_sid)
 
             if state == "offer_booking":
                 if _looks_like_booking_agree(incoming):
-                    set_state_and_draft(clinic_id, user, "collect_name", {})
-                    return _reply_and_return(resp, msg, clinic_id, user, "Great — what’s your full name?", action="offer_booking_yes", sid=twilio_sid)
+                    return _reply_and_return(resp, msg, clinic_id, user, "Great — what’s your full name?", action="offer_booking_yes", sid=twilio_sid, next_state="collect_name", next_draft={})
 
                 if _looks_like_booking_decline(incoming):
                     clear_state_machine(clinic_id, user)
@@ -727,7 +1058,7 @@ def register_routes(app):
                     reply = "No problem. Would you like me to help you book an appointment? (yes/no)"
                     return _reply_and_return(resp, msg, clinic_id, user, reply, action="offer_booking_reprompt", sid=twilio_sid)
 
-            if state in ["idle", None, ""] and (extracted_intent == "book" or is_booking_intent(incoming)):
+            if state in _IDLE_STATES and (extracted_intent == "book" or is_booking_intent(incoming)):
                 draft = draft or {}
 
                 if extracted.get("name"):
@@ -743,162 +1074,43 @@ def register_routes(app):
                 log_event("BOOKING_START", clinic_id=clinic_id, sid=twilio_sid, draft=draft)
 
                 if not draft.get("name"):
-                    set_state_and_draft(clinic_id, user, "collect_name", draft)
-                    return _reply_and_return(resp, msg, clinic_id, user, "Sure. What's your full name?", action="collect_name", sid=twilio_sid)
+                    return _reply_and_return(resp, msg, clinic_id, user, "Sure. What's your full name?", action="collect_name", sid=twilio_sid, next_state="collect_name", next_draft=draft)
 
                 if not draft.get("date"):
-                    set_state_and_draft(clinic_id, user, "collect_date", draft)
-                    return _reply_and_return(resp, msg, clinic_id, user, "What date would you like? (YYYY-MM-DD)", action="collect_date", sid=twilio_sid)
+                    return _reply_and_return(resp, msg, clinic_id, user, "What date would you like? (YYYY-MM-DD)", action="collect_date", sid=twilio_sid, next_state="collect_date", next_draft=draft)
 
-                date = draft.get("date", "").strip()
+                date = draft.get("date", "")
                 if not is_open_on_date(date, tz_name, weekly):
-                    set_state_and_draft(clinic_id, user, "collect_date", draft)
-                    return _reply_and_return(resp, msg, clinic_id, user, "Sorry, we’re closed on that day. Please choose another date.", action="closed_on_date", sid=twilio_sid, date=date)
+                    return _reply_and_return(resp, msg, clinic_id, user, "Sorry, we’re closed on that day. Please choose another date.", action="closed_on_date", sid=twilio_sid, date=date, next_state="collect_date", next_draft=draft)
 
                 if not draft.get("time"):
-                    set_state_and_draft(clinic_id, user, "collect_time", draft)
                     reply = f"What time would you prefer? (HH:MM) e.g. 14:00. Slots are {slot_minutes} minutes."
-                    return _reply_and_return(resp, msg, clinic_id, user, reply, action="collect_time", sid=twilio_sid)
+                    return _reply_and_return(resp, msg, clinic_id, user, reply, action="collect_time", sid=twilio_sid, next_state="collect_time", next_draft=draft)
 
                 time_24 = normalize_time_to_24h(draft.get("time", ""))
                 if not time_24:
                     draft.pop("time", None)
-                    set_state_and_draft(clinic_id, user, "collect_time", draft)
-                    return _reply_and_return(resp, msg, clinic_id, user, "Please type the time like 09:30 (HH:MM) or 2:30 PM.", action="invalid_time_format", sid=twilio_sid)
-
-                if not is_time_within_hours(date, time_24, tz_name, weekly):
-                    set_state_and_draft(clinic_id, user, "collect_time", draft)
-                    hours_str = format_opening_hours_for_day(date, tz_name, weekly)
-                    reply = f"That time is outside working hours for {date}. Available: {hours_str}."
-                    return _reply_and_return(resp, msg, clinic_id, user, reply, action="time_outside_hours", sid=twilio_sid, date=date, time=time_24)
-
-                if not is_slot_aligned(time_24, slot_minutes):
-                    set_state_and_draft(clinic_id, user, "collect_time", draft)
-                    reply = f"Please choose a time that matches our {slot_minutes}-minute slots (e.g. 09:00, 09:30, 10:00)."
-                    return _reply_and_return(resp, msg, clinic_id, user, reply, action="slot_not_aligned", sid=twilio_sid, time=time_24)
-
-                is_taken = check_double_booking(clinic_id, date, time_24, clinic_sheet_id, clinic_sheet_tab)
-                log_event("DOUBLE_BOOKING_CHECK", clinic_id=clinic_id, sid=twilio_sid, date=date, time=time_24, taken=is_taken)
-
-                if is_taken:
-                    set_state_and_draft(clinic_id, user, "collect_time", draft)
-                    return _reply_and_return(resp, msg, clinic_id, user, "That slot is already booked. Choose another time.", action="slot_taken", sid=twilio_sid, date=date, time=time_24)
-
-                draft["time"] = time_24
-                set_state_and_draft(clinic_id, user, "confirm", draft)
-                reply = f"Confirm appointment on {date} at {time_24}? (yes/no)"
-                return _reply_and_return(resp, msg, clinic_id, user, reply, action="confirm_prompt", sid=twilio_sid, draft=draft)
-
-            if state == "collect_name":
-                draft["name"] = incoming.strip()
-                set_state_and_draft(clinic_id, user, "collect_date", draft)
-                return _reply_and_return(resp, msg, clinic_id, user, "What date would you like? (YYYY-MM-DD)", action="name_collected", sid=twilio_sid, draft=draft)
-
-            if state == "collect_date":
-                if looks_like_date(incoming):
-                    date_str = incoming.strip()
-
-                    if not is_open_on_date(date_str, tz_name, weekly):
-                        return _reply_and_return(resp, msg, clinic_id, user, "Sorry, we’re closed on that day. Please choose another date.", action="collect_date_closed", sid=twilio_sid, date=date_str)
-
-                    draft["date"] = date_str
-                    set_state_and_draft(clinic_id, user, "collect_time", draft)
-                    reply = f"What time would you prefer? (HH:MM) e.g. 14:00. Slots are {slot_minutes} minutes."
-                    return _reply_and_return(resp, msg, clinic_id, user, reply, action="date_collected", sid=twilio_sid, draft=draft)
-
-                reply = "Please confirm the date in this format: YYYY-MM-DD (example: 2026-01-30)."
-                return _reply_and_return(resp, msg, clinic_id, user, reply, action="collect_date_invalid", sid=twilio_sid)
-
-            if state == "collect_time":
-                time_24 = normalize_time_to_24h(incoming)
-                if not time_24:
-                    return _reply_and_return(resp, msg, clinic_id, user, "Please type the time like 09:30 (HH:MM) or 2:30 PM.", action="collect_time_invalid", sid=twilio_sid)
-
-                date = draft.get("date", "")
+                    return _reply_and_return(resp, msg, clinic_id, user, "Please type the time like 09:30 (HH:MM) or 2:30 PM.", action="invalid_time_format", sid=twilio_sid, next_state="collect_time", next_draft=draft)
 
                 if not is_time_within_hours(date, time_24, tz_name, weekly):
                     hours_str = format_opening_hours_for_day(date, tz_name, weekly)
                     reply = f"That time is outside working hours for {date}. Available: {hours_str}."
-                    return _reply_and_return(resp, msg, clinic_id, user, reply, action="collect_time_outside_hours", sid=twilio_sid, date=date, time=time_24)
+                    return _reply_and_return(resp, msg, clinic_id, user, reply, action="time_outside_hours", sid=twilio_sid, date=date, time=time_24, next_state="collect_time", next_draft=draft)
 
                 if not is_slot_aligned(time_24, slot_minutes):
                     reply = f"Please choose a time that matches our {slot_minutes}-minute slots (e.g. 09:00, 09:30, 10:00)."
-                    return _reply_and_return(resp, msg, clinic_id, user, reply, action="collect_time_not_aligned", sid=twilio_sid, time=time_24)
+                    return _reply_and_return(resp, msg, clinic_id, user, reply, action="slot_not_aligned", sid=twilio_sid, time=time_24, next_state="collect_time", next_draft=draft)
 
                 is_taken = check_double_booking(clinic_id, date, time_24, clinic_sheet_id, clinic_sheet_tab)
                 log_event("DOUBLE_BOOKING_CHECK", clinic_id=clinic_id, sid=twilio_sid, date=date, time=time_24, taken=is_taken)
 
                 if is_taken:
-                    return _reply_and_return(resp, msg, clinic_id, user, "That slot is already booked. Choose another time.", action="collect_time_slot_taken", sid=twilio_sid, date=date, time=time_24)
+                    return _reply_and_return(resp, msg, clinic_id, user, "That slot is already booked. Choose another time.", action="slot_taken", sid=twilio_sid, date=date, time=time_24, next_state="collect_time", next_draft=draft)
 
                 draft["time"] = time_24
-                set_state_and_draft(clinic_id, user, "confirm", draft)
-                reply = f"Confirm appointment on {date} at {time_24}? (yes/no)"
-                return _reply_and_return(resp, msg, clinic_id, user, reply, action="collect_time_confirm", sid=twilio_sid, draft=draft)
-
-            if state == "confirm":
-                if incoming.lower() in ["yes", "y"]:
-                    name = draft.get("name", "").strip()
-                    date = draft.get("date", "").strip()
-                    time_24 = draft.get("time", "").strip()
-
-                    log_event("BOOKING_CONFIRM_START", clinic_id=clinic_id, sid=twilio_sid, name=name, date=date, time=time_24)
-
-                    appt_id, ref_code = save_appointment_local(
-                        clinic_id,
-                        user,
-                        name,
-                        date,
-                        time_24,
-                        source_message_sid=twilio_sid
-                    )
-                    log_event("BOOKING_SAVED_DB", clinic_id=clinic_id, sid=twilio_sid, appointment_id=appt_id, ref_code=ref_code)
-
-                    ok = append_to_sheet(date, time_24, name, user, clinic_sheet_id, clinic_sheet_tab)
-                    log_event("SHEETS_APPEND_RESULT", clinic_id=clinic_id, sid=twilio_sid, appointment_id=appt_id, ref_code=ref_code, ok=ok)
-
-                    if ok:
-                        try:
-                            append_ref_to_latest_row(ref_code, clinic_sheet_id, clinic_sheet_tab)
-                            log_event("SHEETS_APPEND_REF_OK", clinic_id=clinic_id, sid=twilio_sid, ref_code=ref_code)
-                        except Exception as e:
-                            log_event("SHEETS_APPEND_REF_FAILED", clinic_id=clinic_id, sid=twilio_sid, ref_code=ref_code, error=repr(e))
-
-                    if ok:
-                        update_sheet_sync_status(appt_id, "synced")
-                    else:
-                        update_sheet_sync_status(appt_id, "failed", "Sheets append failed (see logs)")
-
-                    clear_state_machine(clinic_id, user)
-
-                    reply = f"✅ Appointment confirmed for {date} at {time_24}\nRef: {ref_code}\nTo cancel: cancel {ref_code}"
-
-                    _enqueue_admin_notify(
-                        clinic_id,
-                        clinic_settings,
-                        f"✅ Appointment BOOKED\nDate: {date}\nTime: {time_24}\nName: {name}\nPatient: {user}\nRef: {ref_code}",
-                        appointment_id=appt_id
-                    )
-
-                    _schedule_patient_reminder(
-                        clinic_id=clinic_id,
-                        user_number=user,
-                        clinic_settings=clinic_settings,
-                        appointment_id=appt_id,
-                        patient_name=name,
-                        date=date,
-                        time_24h=time_24,
-                        ref_code=ref_code,
-                        tz_name=tz_name
-                    )
-
-                    return _reply_and_return(resp, msg, clinic_id, user, reply, action="booking_confirmed", sid=twilio_sid, appointment_id=appt_id, ref_code=ref_code)
-
-                if incoming.lower() in ["no", "n"]:
-                    clear_state_machine(clinic_id, user)
-                    return _reply_and_return(resp, msg, clinic_id, user, "No problem — booking cancelled. Type 'book' to start again.", action="booking_cancelled_at_confirm", sid=twilio_sid)
-
-                return _reply_and_return(resp, msg, clinic_id, user, "Please reply with 'yes' to confirm or 'no' to cancel.", action="confirm_reprompt", sid=twilio_sid)
+                reply = _CONFIRM_PROMPT_TMPL.format(date=date, time=time_24)
+                twiml = _fill_twiml(_CONFIRM_PROMPT_TWIML, date=date, time=time_24)
+                return _reply_and_return(resp, msg, clinic_id, user, reply, action="confirm_prompt", sid=twilio_sid, draft=draft, next_state="confirm", next_draft=draft, twiml=twiml)
 
             reply = ai_reply(clinic, user, incoming)
             log_event("AI_REPLY_RAW", clinic_id=clinic_id, sid=twilio_sid, reply=reply)
@@ -907,13 +1119,14 @@ def register_routes(app):
             if OFFER_BOOKING_MARKER in reply:
                 offered_booking = True
                 reply = reply.replace(OFFER_BOOKING_MARKER, "").strip()
-                reply = re.sub(r"\n{3,}", "\n\n", reply).strip()
+                reply = _BLANK_LINES_RE.sub("\n\n", reply).strip()
                 log_event("AI_REPLY_OFFER_BOOKING", clinic_id=clinic_id, sid=twilio_sid)
 
-            if state in ["idle", None, ""] and offered_booking:
-                set_state_and_draft(clinic_id, user, "offer_booking", {})
+            next_state = None
+            if state in _IDLE_STATES and offered_booking:
+                next_state = "offer_booking"
 
-            return _reply_and_return(resp, msg, clinic_id, user, reply, action="ai_reply", sid=twilio_sid, offered_booking=offered_booking)
+            return _reply_and_return(resp, msg, clinic_id, user, reply, action="ai_reply", sid=twilio_sid, offered_booking=offered_booking, next_state=next_state, next_draft={})
 
         except Exception as e:
             tb = traceback.format_exc()
@@ -922,7 +1135,7 @@ def register_routes(app):
             try:
                 clinic_id_safe = locals().get("clinic_id")
                 user_safe = locals().get("user", "")
-                reply = "Sorry, something went wrong on our side. Please try again in a moment."
+                reply = _FATAL_REPLY
                 return _reply_and_return(
                     resp,
                     msg,
@@ -932,7 +1145,4 @@ def register_routes(app):
                     action="fatal_error"
                 )
             except Exception:
-                fallback_resp = MessagingResponse()
-                fallback_msg = fallback_resp.message()
-                fallback_msg.body("Sorry, something went wrong on our side. Please try again in a moment.")
-                return Response(str(fallback_resp), mimetype="application/xml")
\ No newline at end of file
+                return Response(_FIXED_TWIML[_FATAL_REPLY], mimetype="application/xml", direct_passthrough=True)
\ No newline at end of file
@@ -1,17 +1,33 @@
 import os
 import re
 import json
+import time
+import threading
+from functools import lru_cache
 
+import httplib2
+import google_auth_httplib2
 from google.oauth2.service_account import Credentials
 from googleapiclient.discovery import build
+from googleapiclient.http import HttpRequest
 
 from config import (
     SERVICE_JSON, SERVICE_FILE,
     GOOGLE_SHEETS_ID, SHEET_TAB,
     DEFAULT_SHEET_ID, DEFAULT_SHEET_TAB,
+    SHEETS_HTTP_TIMEOUT_SECONDS,
 )
 
 sheets_api = None
+_sheets_creds = None
+
+# httplib2 is not thread-safe; each thread (gthread workers, the background
+# sheets executor) gets its own authorized HTTP object, reused across calls.
+_thread_local = threading.local()
+
+# Header layouts rarely change; reuse the resolved column map for a while
+HEADER_MAP_TTL_SECONDS = 300
+_header_map_cache = {}
 
 def load_service_info():
     if SERVICE_JSON:
@@ -27,10 +43,12 @@ def a1(tab: str, cells: str) -> str:
     safe = tab.replace("'", "''")
     return f"'{safe}'!{cells}"
 
+_WS_RE = re.compile(r"\s+")
+
 def _norm_header(s: str) -> str:
-    return re.sub(r"\s+", " ", (s or "").strip().lower())
+    return _WS_RE.sub(" ", (s or "").strip().lower())
 
-def _index_to_col(idx: int) -> str:
+def _index_to_col_slow(idx: int) -> str:
     idx += 1
     out = ""
     while idx > 0:
@@ -38,14 +56,55 @@ def _index_to_col(idx: int) -> str:
         out = chr(65 + r) + out
     return out
 
-def _col_to_idx(col: str) -> int:
-    col = (col or "").strip().upper()
+def _col_to_idx_slow(col: str) -> int:
     n = 0
     for ch in col:
         if "A" <= ch <= "Z":
             n = n * 26 + (ord(ch) - 64)
     return n - 1
 
+# Column letters <-> 0-based index, precomputed for A..AMJ (1024 columns)
+IDX_TO_COL = tuple(_index_to_col_slow(i) for i in range(1024))
+COL_TO_IDX = {c: i for i, c in enumerate(IDX_TO_COL)}
+
+def _index_to_col(idx: int) -> str:
+    if 0 <= idx < len(IDX_TO_COL):
+        return IDX_TO_COL[idx]
+    return _index_to_col_slow(idx)
+
+def _col_to_idx(col: str) -> int:
+    col = (col or "").strip().upper()
+    idx = COL_TO_IDX.get(col)
+    return idx if idx is not None else _col_to_idx_slow(col)
+
+def _header_map_from_row(header_row):
+    header_index = {}
+    for i, cell in enumerate(header_row):
+        key = _norm_header(cell)
+        if key:
+            header_index[key] = i
+
+    wanted = {
+        "date": ["date", "appointment date", "booking date"],
+        "time": ["time", "appointment time", "booking time"],
+        "name": ["name", "patient name", "full name"],
+        "phone": ["phone", "phone number", "mobile", "number"],
+        "status": ["status"],
+        "source": ["source"],
+        # ✅ PATCH: support REF column for cancel/reschedule syncing
+        "ref": ["ref", "reference", "reference code", "ref code"],
+    }
+
+    out = {}
+    for field, variants in wanted.items():
+        for v in variants:
+            vkey = _norm_header(v)
+            if vkey in header_index:
+                out[field] = _index_to_col(header_index[vkey])
+                break
+
+    return out
+
 def get_sheet_header_map(spreadsheet_id=None, sheet_tab=None):
     global sheets_api
     if not sheets_api:
@@ -56,49 +115,73 @@ def get_sheet_header_map(spreadsheet_id=None, sheet_tab=None):
     if not sid:
         return None
 
+    key = (sid, tab)
+    cached = _header_map_cache.get(key)
+    if cached and time.monotonic() - cached[0] < HEADER_MAP_TTL_SECONDS:
+        return dict(cached[1])
+
     try:
         res = sheets_api.values().get(
             spreadsheetId=sid,
-            range=a1(tab, "A1:Z1")
+            range=a1(tab, "A1:Z1"),
+            fields="values"
         ).execute()
         header_row = (res.get("values") or [[]])[0]
-
-        header_index = {}
-        for i, cell in enumerate(header_row):
-            key = _norm_header(cell)
-            if key:
-                header_index[key] = i
-
-        wanted = {
-            "date": ["date", "appointment date", "booking date"],
-            "time": ["time", "appointment time", "booking time"],
-            "name": ["name", "patient name", "full name"],
-            "phone": ["phone", "phone number", "mobile", "number"],
-            "status": ["status"],
-            "source": ["source"],
-            # ✅ PATCH: support REF column for cancel/reschedule syncing
-            "ref": ["ref", "reference", "reference code", "ref code"],
-        }
-
-        out = {}
-        for field, variants in wanted.items():
-            for v in variants:
-                vkey = _norm_header(v)
-                if vkey in header_index:
-                    out[field] = _index_to_col(header_index[vkey])
-                    break
-
-        return out
+        out = _header_map_from_row(header_row)
+        _header_map_cache[key] = (time.monotonic(), out)
+        return dict(out)
     except Exception as e:
         print("Header map read failed:", repr(e))
         return None
 
+def load_sheet_snapshot(spreadsheet_id, sheet_tab):
+    """
+    Live read of header (A1:Z1) + data rows (A2:Z) in one batchGet.
+    Refreshes the header cache. Returns (header_map, rows); raises on API errors.
+    """
+    res = sheets_api.values().batchGet(
+        spreadsheetId=spreadsheet_id,
+        ranges=[a1(sheet_tab, "A1:Z1"), a1(sheet_tab, "A2:Z")],
+        fields="valueRanges(range,values)"
+    ).execute()
+    value_ranges = res.get("valueRanges", [])
+    header_row = ((value_ranges[0].get("values") if value_ranges else None) or [[]])[0]
+    data_rows = value_ranges[1].get("values", []) if len(value_ranges) > 1 else []
+
+    header_map = _header_map_from_row(header_row)
+    _header_map_cache[(spreadsheet_id, sheet_tab)] = (time.monotonic(), header_map)
+    return dict(header_map), data_rows
+
+def clear_header_cache(spreadsheet_id=None, sheet_tab=None):
+    """
+    Drops cached header maps (one tab, or all when no id is given) so the next
+    call re-reads A1:Z1. Returns how many entries were dropped.
+    """
+    if spreadsheet_id:
+        key = (spreadsheet_id, sheet_tab or DEFAULT_SHEET_TAB)
+        return 1 if _header_map_cache.pop(key, None) else 0
+    count = len(_header_map_cache)
+    _header_map_cache.clear()
+    return count
+
+def _thread_http():
+    http = getattr(_thread_local, "http", None)
+    if http is None:
+        http = google_auth_httplib2.AuthorizedHttp(_sheets_creds, http=httplib2.Http(timeout=SHEETS_HTTP_TIMEOUT_SECONDS))
+        _thread_local.http = http
+    return http
+
+def _build_request(http, *args, **kwargs):
+    return HttpRequest(_thread_http(), *args, **kwargs)
+
 def init_sheets():
     """
     Initializes sheets_api if credentials + sheet id exist.
-    Keeps your exact behavior + logs.
+    Keeps your exact behavior + logs. Safe to call more than once.
     """
-    global sheets_api
+    global sheets_api, _sheets_creds
+    if sheets_api:
+        return
 
     service_info = None
     try:
@@ -111,7 +194,13 @@ def init_sheets():
         try:
             SCOPES = ["https://www.googleapis.com/auth/spreadsheets"]
             creds = Credentials.from_service_account_info(service_info, scopes=SCOPES)
-            sheets_service = build("sheets", "v4", credentials=creds)
+            _sheets_creds = creds
+            sheets_service = build(
+                "sheets", "v4",
+                http=_thread_http(),
+                requestBuilder=_build_request,
+                cache_discovery=False
+            )
             sheets_api = sheets_service.spreadsheets()
             print("Google Sheets initialized")
         except Exception as e:
@@ -119,9 +208,26 @@ def init_sheets():
     else:
         print("Service account not set or sheet id not set — Sheets disabled")
 
-def append_to_sheet(date, time, name, phone, sheet_id=None, sheet_tab=None):
+_APPEND_FIELDS = ("date", "time", "name", "phone", "status", "source")
+
+@lru_cache(maxsize=32)
+def _append_row_layout(cols):
+    """
+    For the column letters of _APPEND_FIELDS, returns (blank row template, column indexes).
+    """
+    slots = tuple(_col_to_idx(c) for c in cols)
+    return [""] * (max(slots) + 1), slots
+
+def append_to_sheet(date, time, name, phone, sheet_id=None, sheet_tab=None, status="Booked"):
+    return append_rows_to_sheet([(date, time, name, phone)], sheet_id, sheet_tab, status)
+
+def append_rows_to_sheet(rows, sheet_id=None, sheet_tab=None, status="Booked"):
+    """
+    Appends (date, time, name, phone) bookings in a single values.append call,
+    all with the given STATUS.
+    """
     global sheets_api
-    if not sheets_api:
+    if not sheets_api or not rows:
         return False
 
     sid = (sheet_id or GOOGLE_SHEETS_ID or DEFAULT_SHEET_ID or "").strip()
@@ -132,44 +238,26 @@ def append_to_sheet(date, time, name, phone, sheet_id=None, sheet_tab=None):
     try:
         header_map = get_sheet_header_map(sid, tab)
 
-        if header_map:
-            required = ["date", "time", "name", "phone", "status", "source"]
-            missing = [k for k in required if k not in header_map]
-            if not missing:
-                date_i = _col_to_idx(header_map["date"])
-                time_i = _col_to_idx(header_map["time"])
-                name_i = _col_to_idx(header_map["name"])
-                phone_i = _col_to_idx(header_map["phone"])
-                status_i = _col_to_idx(header_map["status"])
-                source_i = _col_to_idx(header_map["source"])
-
-                max_i = max(date_i, time_i, name_i, phone_i, status_i, source_i)
-                row_values = [""] * (max_i + 1)
-
-                row_values[date_i] = date
-                row_values[time_i] = time
-                row_values[name_i] = name
-                row_values[phone_i] = phone
-                row_values[status_i] = "Booked"
-                row_values[source_i] = "WhatsApp"
-
-                sheets_api.values().append(
-                    spreadsheetId=sid,
-                    range=a1(tab, "A:F"),
-                    valueInputOption="USER_ENTERED",
-                    insertDataOption="INSERT_ROWS",
-                    body={"values": [row_values]}
-                ).execute()
-                return True
+        all_values = []
+        if header_map and not [k for k in _APPEND_FIELDS if k not in header_map]:
+            template, slots = _append_row_layout(tuple(header_map[k] for k in _APPEND_FIELDS))
+            for date, time_, name, phone in rows:
+                row_values = template.copy()
+                for i, value in zip(slots, (date, time_, name, phone, status, "WhatsApp")):
+                    row_values[i] = value
+                all_values.append(row_values)
+        else:
+            # fallback A–F
+            for date, time_, name, phone in rows:
+                all_values.append([date, time_, name, phone, status, "WhatsApp"])
 
-        # fallback A–F
-        row_values = [date, time, name, phone, "Booked", "WhatsApp"]
         sheets_api.values().append(
             spreadsheetId=sid,
             range=a1(tab, "A:F"),
             valueInputOption="USER_ENTERED",
             insertDataOption="INSERT_ROWS",
-            body={"values": [row_values]}
+            body={"values": all_values},
+            fields="spreadsheetId"
         ).execute()
         return True
 
@@ -202,7 +290,8 @@ def append_ref_to_latest_row(ref_code: str, sheet_id=None, sheet_tab=None) -> bo
         return False
 
     try:
-        header_map = get_sheet_header_map(sid, tab) or {}
+        # Header + rows in one round-trip; rows must be live since we write by row number
+        header_map, rows = load_sheet_snapshot(sid, tab)
         if "ref" not in header_map:
             print("Sheets REF write skipped: no REF column detected in header.")
             return False
@@ -211,12 +300,6 @@ def append_ref_to_latest_row(ref_code: str, sheet_id=None, sheet_tab=None) -> bo
         ref_i = _col_to_idx(ref_col_letter)
 
         # We locate "latest row" by scanning DATE column (or column A) from A2:Z
-        res = sheets_api.values().get(
-            spreadsheetId=sid,
-            range=a1(tab, "A2:Z")
-        ).execute()
-
-        rows = res.get("values", [])
         if not rows:
             return False
 
@@ -240,7 +323,8 @@ def append_ref_to_latest_row(ref_code: str, sheet_id=None, sheet_tab=None) -> bo
             spreadsheetId=sid,
             range=target_range,
             valueInputOption="RAW",
-            body={"values": [[ref_code]]}
+            body={"values": [[ref_code]]},
+            fields="spreadsheetId"
         ).execute()
 
         return True
@@ -269,7 +353,7 @@ def update_sheet_status_by_ref(ref_code: str, new_status: str, sheet_id=None, sh
         return False
 
     try:
-        header_map = get_sheet_header_map(sid, tab) or {}
+        header_map, rows = load_sheet_snapshot(sid, tab)
         if "ref" not in header_map or "status" not in header_map:
             print("Sheets status update skipped: missing REF/STATUS columns.")
             return False
@@ -277,12 +361,6 @@ def update_sheet_status_by_ref(ref_code: str, new_status: str, sheet_id=None, sh
         ref_i = _col_to_idx(header_map["ref"])
         status_col_letter = header_map["status"]
 
-        res = sheets_api.values().get(
-            spreadsheetId=sid,
-            range=a1(tab, "A2:Z")
-        ).execute()
-
-        rows = res.get("values", [])
         for idx, row in enumerate(rows):
             sheet_ref = row[ref_i] if len(row) > ref_i else ""
             if str(sheet_ref).strip().upper() == ref_code.upper():
@@ -293,7 +371,8 @@ def update_sheet_status_by_ref(ref_code: str, new_status: str, sheet_id=None, sh
                     spreadsheetId=sid,
                     range=target_range,
                     valueInputOption="RAW",
-                    body={"values": [[new_status]]}
+                    body={"values": [[new_status]]},
+                    fields="spreadsheetId"
                 ).execute()
 
                 return True
@@ -0,0 +1,67 @@
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+import ai
+
+
+def _completion(text):
+    return SimpleNamespace(
+        choices=[SimpleNamespace(message=SimpleNamespace(content=text))],
+        usage=None,
+    )
+
+
+class ReplyCacheTest(unittest.TestCase):
+    def setUp(self):
+        ai._reply_cache.clear()
+        self.addCleanup(ai._reply_cache.clear)
+
+        self.history = []
+        answers = iter(["answer 1", "answer 2", "answer 3"])
+        self.create = mock.Mock(side_effect=lambda **kwargs: _completion(next(answers)))
+        client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=self.create)))
+
+        for p in (
+            mock.patch.object(ai, "openai_client", client),
+            mock.patch.object(ai, "load_conversation_summary", return_value=("", 0)),
+            mock.patch.object(ai, "load_recent_messages", side_effect=lambda *a, **k: list(self.history)),
+            mock.patch.object(ai, "_request_history_summary"),
+        ):
+            p.start()
+            self.addCleanup(p.stop)
+
+    def test_same_clinic_and_context_reuses_answer(self):
+        clinic = {"id": "clinic-a", "name": "Smile Dental"}
+
+        first = ai.ai_reply(clinic, "+254700000001", "What are your hours?")
+        second = ai.ai_reply(clinic, "+254700000002", "what are  your hours?")
+
+        self.assertEqual(first, second)
+        self.assertEqual(self.create.call_count, 1)
+
+    def test_not_shared_across_clinics_with_the_same_name(self):
+        clinic_a = {"id": "clinic-a", "name": "Smile Dental"}
+        clinic_b = {"id": "clinic-b", "name": "Smile Dental"}
+
+        reply_a = ai.ai_reply(clinic_a, "+254700000001", "How much is a cleaning?")
+        reply_b = ai.ai_reply(clinic_b, "+254700000001", "How much is a cleaning?")
+
+        self.assertNotEqual(reply_a, reply_b)
+        self.assertEqual(self.create.call_count, 2)
+
+    def test_previous_assistant_turn_change_misses(self):
+        clinic = {"id": "clinic-a", "name": "Smile Dental"}
+
+        self.history = [{"role": "assistant", "content": "We open at 9am."}]
+        first = ai.ai_reply(clinic, "+254700000001", "ok")
+
+        self.history = [{"role": "assistant", "content": "Your appointment is cancelled."}]
+        second = ai.ai_reply(clinic, "+254700000001", "ok")
+
+        self.assertNotEqual(first, second)
+        self.assertEqual(self.create.call_count, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
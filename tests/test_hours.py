@@ -0,0 +1,50 @@
+import datetime
+import unittest
+
+from hours import normalize_time_to_24h, parse_hhmm_to_minutes, parse_ymd, weekday_key_from_date
+
+
+class NormalizeTimeTest(unittest.TestCase):
+    def test_24h_and_12h_forms(self):
+        cases = {
+            "14:00": "14:00",
+            "9:30": "09:30",
+            " 09:30 ": "09:30",
+            "2:30 PM": "14:30",
+            "2:30pm": "14:30",
+            "12:00 am": "00:00",
+            "12:15 PM": "12:15",
+        }
+        for raw, expected in cases.items():
+            with self.subTest(raw=raw):
+                self.assertEqual(normalize_time_to_24h(raw), expected)
+
+    def test_rejects_invalid_times(self):
+        for raw in ("24:00", "9:60", "13:00 pm", "0:30 am", "930", "", None, "9:5"):
+            with self.subTest(raw=raw):
+                self.assertIsNone(normalize_time_to_24h(raw))
+
+    def test_parse_hhmm_to_minutes(self):
+        self.assertEqual(parse_hhmm_to_minutes("09:30"), 570)
+        self.assertIsNone(parse_hhmm_to_minutes("9:30 pm"))
+        self.assertIsNone(parse_hhmm_to_minutes("25:00"))
+
+
+class ParseYmdTest(unittest.TestCase):
+    def test_padded_and_unpadded(self):
+        self.assertEqual(parse_ymd("2026-01-30"), datetime.date(2026, 1, 30))
+        self.assertEqual(parse_ymd("2026-1-5"), datetime.date(2026, 1, 5))
+
+    def test_rejects_bad_dates(self):
+        for raw in ("2026-02-30", "2026-13-01", "30/01/2026", "2026-01-30 10:00", "", None):
+            with self.subTest(raw=raw):
+                with self.assertRaises(ValueError):
+                    parse_ymd(raw)
+
+    def test_weekday_key(self):
+        self.assertEqual(weekday_key_from_date("2026-01-30", "Africa/Nairobi"), "fri")
+        self.assertEqual(weekday_key_from_date("2026-2-1", "UTC"), "sun")
+
+
+if __name__ == "__main__":
+    unittest.main()
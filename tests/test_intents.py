@@ -0,0 +1,33 @@
+import unittest
+
+from intents import is_booking_intent, is_cancel_intent, is_reschedule_intent, looks_like_date
+
+
+class IntentTest(unittest.TestCase):
+    def test_booking_intent(self):
+        self.assertTrue(is_booking_intent("I want to BOOK a visit"))
+        self.assertTrue(is_booking_intent("any appointments tomorrow?"))
+        self.assertFalse(is_booking_intent("I left my notebook there"))
+        self.assertFalse(is_booking_intent(""))
+
+    def test_cancel_and_reschedule_intent(self):
+        self.assertTrue(is_cancel_intent("please Cancel Appointment"))
+        self.assertTrue(is_reschedule_intent("can I change time?"))
+        self.assertFalse(is_cancel_intent("what are your hours"))
+        self.assertFalse(is_reschedule_intent(None))
+
+
+class LooksLikeDateTest(unittest.TestCase):
+    def test_accepts_calendar_dates(self):
+        for raw in ("2026-01-30", " 2026-1-5 ", "2028-02-29"):
+            with self.subTest(raw=raw):
+                self.assertTrue(looks_like_date(raw))
+
+    def test_rejects_non_dates(self):
+        for raw in ("2026-02-30", "2027-02-29", "30/01/2026", "tomorrow", "", None):
+            with self.subTest(raw=raw):
+                self.assertFalse(looks_like_date(raw))
+
+
+if __name__ == "__main__":
+    unittest.main()
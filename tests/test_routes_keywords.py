@@ -0,0 +1,31 @@
+import unittest
+
+from routes import _looks_like_booking_agree, _looks_like_booking_decline
+
+
+class BookingAgreeTest(unittest.TestCase):
+    def test_agree_words_and_inflections(self):
+        for raw in ("yes", "Yess!", "ok go ahead", "any appointments tomorrow?", "I booked before", "can you help me"):
+            with self.subTest(raw=raw):
+                self.assertTrue(_looks_like_booking_agree(raw))
+
+    def test_no_partial_word_matches(self):
+        for raw in ("scheduling", "notebook", "I know", "", None):
+            with self.subTest(raw=raw):
+                self.assertFalse(_looks_like_booking_agree(raw))
+
+
+class BookingDeclineTest(unittest.TestCase):
+    def test_decline_words_and_phrases(self):
+        for raw in ("no", "Nope.", "No thanks", "maybe later", "I'm just asking"):
+            with self.subTest(raw=raw):
+                self.assertTrue(_looks_like_booking_decline(raw))
+
+    def test_no_partial_word_matches(self):
+        for raw in ("I know", "nobody", "notice", "", None):
+            with self.subTest(raw=raw):
+                self.assertFalse(_looks_like_booking_decline(raw))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,24 @@
+import unittest
+
+from routes import _BOOKED_TMPL, _BOOKED_TWIML, _CONFIRM_PROMPT_TMPL, _CONFIRM_PROMPT_TWIML, _fill_twiml, _twiml_bytes
+
+
+class FillTwimlTest(unittest.TestCase):
+    def test_matches_building_the_reply(self):
+        values = {"date": "2026-01-30", "time": "10:00", "ref": "AP-7K2Q9X"}
+        self.assertEqual(_fill_twiml(_BOOKED_TWIML, **values), _twiml_bytes(_BOOKED_TMPL.format(**values)))
+
+    def test_escapes_markup_in_values(self):
+        values = {"date": "<b>Jan & Feb</b>", "time": "10:00 & later"}
+        self.assertEqual(
+            _fill_twiml(_CONFIRM_PROMPT_TWIML, **values),
+            _twiml_bytes(_CONFIRM_PROMPT_TMPL.format(**values)),
+        )
+
+    def test_values_are_not_substituted_again(self):
+        values = {"date": "{ref}", "time": "{time}", "ref": "AP-&<>"}
+        self.assertEqual(_fill_twiml(_BOOKED_TWIML, **values), _twiml_bytes(_BOOKED_TMPL.format(**values)))
+
+
+if __name__ == "__main__":
+    unittest.main()
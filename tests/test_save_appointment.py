@@ -0,0 +1,52 @@
+import unittest
+from unittest import mock
+
+import booking
+
+
+class SaveAppointmentLocalTest(unittest.TestCase):
+    def setUp(self):
+        self.cursor = mock.MagicMock()
+        conn = mock.MagicMock()
+        conn.cursor.return_value.__enter__.return_value = self.cursor
+        get_conn = mock.MagicMock()
+        get_conn.return_value.__enter__.return_value = conn
+
+        for p in (
+            mock.patch.object(booking, "get_conn", get_conn),
+            mock.patch.object(booking, "generate_ref_code", side_effect=["AP-AAAAAA", "AP-BBBBBB"]),
+        ):
+            p.start()
+            self.addCleanup(p.stop)
+
+    def _save(self, **kwargs):
+        return booking.save_appointment_local("clinic-a", "+254700000001", "Jane", "2026-01-30", "10:00", **kwargs)
+
+    def test_webhook_retry_returns_existing_row(self):
+        # INSERT conflicts, then the lookup by source_message_sid finds the earlier booking
+        self.cursor.fetchone.side_effect = [None, (42, "AP-OLD123")]
+
+        self.assertEqual(self._save(source_message_sid="SM123"), (42, "AP-OLD123"))
+        self.assertEqual(self.cursor.execute.call_count, 2)
+
+    def test_booked_slot_raises_slot_taken(self):
+        # INSERT conflicts, no row for this message, but the slot is held
+        self.cursor.fetchone.side_effect = [None, None, (1,)]
+
+        with self.assertRaises(booking.SlotTakenError):
+            self._save(source_message_sid="SM123")
+
+    def test_ref_collision_retries_with_a_new_code(self):
+        # First INSERT conflicts on ref_code only (slot free), second succeeds
+        self.cursor.fetchone.side_effect = [None, None, (7,)]
+
+        self.assertEqual(self._save(), (7, "AP-BBBBBB"))
+        inserted_refs = [
+            call.args[1][6] for call in self.cursor.execute.call_args_list
+            if "INSERT INTO appointments" in call.args[0]
+        ]
+        self.assertEqual(inserted_refs, ["AP-AAAAAA", "AP-BBBBBB"])
+
+
+if __name__ == "__main__":
+    unittest.main()
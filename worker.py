@@ -1,10 +1,11 @@
 import time
 import traceback
 
-from jobs import fetch_and_lock_jobs, mark_done, reschedule_or_fail, enqueue_job, has_pending_sync_job
-from sheets import append_to_sheet
-from db import db_conn, update_sheet_sync_status, load_clinic_settings
+from jobs import fetch_and_lock_jobs, mark_done, reschedule_or_fail, enqueue_jobs, has_pending_sync_job
+from sheets import append_to_sheet, append_ref_to_latest_row, update_sheet_status_by_ref, init_sheets
+from db import init_db, get_conn, update_sheet_sync_status, load_clinic_settings, get_appointment_status
 from clinic import get_clinic_sheet_config
+from ai import init_ai, summarize_history
 
 # ✅ Keep for notify_admin jobs
 from notifier import send_whatsapp
@@ -30,14 +31,23 @@ def handle_job(job):
         sheet_id = payload.get("sheet_id")
         sheet_tab = payload.get("sheet_tab")
 
+        # Write the row's current status: a cancel can land before this job runs
+        status = get_appointment_status(appointment_id) or "Booked"
+
         # ✅ PATCH: expose the REAL reason Sheets fails
         try:
-            ok = append_to_sheet(date, time_, name, phone, sheet_id, sheet_tab)
+            ok = append_to_sheet(date, time_, name, phone, sheet_id, sheet_tab, status)
         except Exception as e:
             update_sheet_sync_status(appointment_id, "failed", f"Sheets exception: {repr(e)}")
             raise  # bubbles up so jobs.last_error captures traceback
 
         if ok:
+            ref_code = payload.get("ref_code")
+            if ref_code:
+                try:
+                    append_ref_to_latest_row(ref_code, sheet_id, sheet_tab)
+                except Exception as e:
+                    print(f"[SYNC_SHEET] REF write failed ref={ref_code}:", repr(e))
             update_sheet_sync_status(appointment_id, "synced")
             return True
         else:
@@ -45,6 +55,23 @@ def handle_job(job):
             update_sheet_sync_status(appointment_id, "failed", "Sheets append returned False (check worker logs)")
             raise RuntimeError("Sheets append returned False")
 
+    if job_type == "sheet_status":
+        appointment_id = payload.get("appointment_id")
+        ref_code = payload.get("ref_code")
+        new_status = payload.get("status")
+        if not ref_code or not new_status:
+            print(f"[SHEET_STATUS] Skipped job_id={job['id']}: missing ref_code/status")
+            return True
+
+        # Run after the booking's own append; raising reschedules with backoff
+        if appointment_id and has_pending_sync_job(appointment_id):
+            raise RuntimeError(f"sync_sheet still pending for appointment {appointment_id}")
+
+        if not update_sheet_status_by_ref(ref_code, new_status, payload.get("sheet_id"), payload.get("sheet_tab")):
+            raise RuntimeError(f"Sheets STATUS update failed or row not found ref={ref_code}")
+        print(f"[SHEET_STATUS] ref={ref_code} status={new_status}")
+        return True
+
     # ✅ Keep admin notifications on normal WhatsApp send
     if job_type == "notify_admin":
         to_number = payload.get("to")
@@ -101,6 +128,13 @@ def handle_job(job):
         )
         return True
 
+    if job_type == "summarize_history":
+        clinic_id = payload.get("clinic_id")
+        user = payload.get("user")
+        if not clinic_id or not user:
+            raise RuntimeError("summarize_history missing clinic_id/user")
+        return summarize_history(clinic_id, user)
+
     print("Unknown job_type:", job_type, "job_id:", job["id"])
     return True
 
@@ -110,43 +144,51 @@ def sweep_and_enqueue_unsynced():
     Auto-retry: find unsynced appointments and enqueue sync_sheet jobs.
     Won't enqueue duplicates if one is already queued/running for the same appointment_id.
     """
-    conn = db_conn()
-    c = conn.cursor()
-    c.execute(
-        """
-        SELECT id, clinic_id, user_number, name, date, time, sheet_sync_status
-        FROM appointments
-        WHERE status='Booked'
-          AND sheet_sync_status IN ('failed','pending')
-        ORDER BY created_at DESC
-        LIMIT %s
-        """,
-        (SWEEP_LIMIT,)
-    )
-    rows = c.fetchall()
-    conn.close()
-
-    enqueued = 0
+    with get_conn() as conn, conn.cursor() as c:
+        c.execute(
+            """
+            SELECT a.id, a.clinic_id, a.user_number, a.name, a.date, a.time, a.ref_code, a.sheet_sync_status,
+                   EXISTS (
+                       SELECT 1 FROM jobs j
+                       WHERE j.job_type='sync_sheet'
+                         AND j.status IN ('queued','running')
+                         AND j.payload->>'appointment_id' = a.id::text
+                   ) AS has_pending
+            FROM appointments a
+            WHERE a.status='Booked'
+              AND a.sheet_sync_status IN ('failed','pending')
+            ORDER BY a.created_at DESC
+            LIMIT %s
+            """,
+            (SWEEP_LIMIT,)
+        )
+        rows = c.fetchall()
+
+    payloads = []
     skipped = 0
+    sheet_config_by_clinic = {}
 
-    for (appt_id, clinic_id, user_number, name, date, time_, sync_status) in rows:
-        if has_pending_sync_job(appt_id):
+    for (appt_id, clinic_id, user_number, name, date, time_, ref_code, sync_status, has_pending) in rows:
+        if has_pending:
             skipped += 1
             continue
 
-        clinic_settings = load_clinic_settings(clinic_id)
-        sheet_id, sheet_tab = get_clinic_sheet_config(clinic_settings)
+        if clinic_id not in sheet_config_by_clinic:
+            sheet_config_by_clinic[clinic_id] = get_clinic_sheet_config(load_clinic_settings(clinic_id))
+        sheet_id, sheet_tab = sheet_config_by_clinic[clinic_id]
 
-        enqueue_job("sync_sheet", {
+        payloads.append({
             "appointment_id": appt_id,
             "date": date,
             "time": time_,
             "name": name,
             "phone": user_number,
+            "ref_code": ref_code,
             "sheet_id": sheet_id,
             "sheet_tab": sheet_tab
         })
-        enqueued += 1
+
+    enqueued = enqueue_jobs("sync_sheet", payloads)
 
     if enqueued or skipped:
         print(f"[SWEEP] Enqueued: {enqueued}, Skipped(existing pending): {skipped}, Checked: {len(rows)}")
@@ -154,6 +196,9 @@ def sweep_and_enqueue_unsynced():
 
 def main():
     print("Worker started ✅ (with auto-retry sweeper)")
+    init_db()
+    init_sheets()
+    init_ai()
     last_sweep = 0
 
     while True: